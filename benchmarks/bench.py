@@ -0,0 +1,383 @@
+"""
+Julabo library benchmarks driven by the bundled simulator.
+
+Measures, for each simulated model (JulaboCF, JulaboHL, JulaboMS) and
+transport (tcp, serial over a pseudo terminal):
+
+- round trip latency percentiles and queries/second of a member read with
+  asyncio and with the synchronous (syncio) stack, both with the nominal
+  model latency and with zero latency (to expose the library overhead)
+- per layer costs without any I/O: encode/decode, member dispatch,
+  protocol lock, back-pressure and metrics collection
+
+Requires the simulator extra (pip install julabo[simulator]).
+Run from the repository root::
+
+    python benchmarks/bench.py --output before.json
+    ... change something ...
+    python benchmarks/bench.py --output after.json
+    python benchmarks/bench.py --compare before.json after.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import julabo  # noqa: E402
+from julabo import connection_for_url, LatencyProfile  # noqa: E402
+from julabo.device import JulaboCF, JulaboHL, JulaboMS  # noqa: E402
+from julabo.protocol import encode, decode, clean  # noqa: E402
+
+
+MODELS = {"CF": JulaboCF, "HL": JulaboHL, "MS": JulaboMS}
+TRANSPORTS = ("tcp", "serial")
+ZERO_LATENCY = LatencyProfile(0, 0, 0, 0)
+REPLY = b"\x1129.45\r\n"
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_ready(kind, address, timeout=10):
+    stop = time.monotonic() + timeout
+    while time.monotonic() < stop:
+        if kind == "serial":
+            if os.path.exists(address):
+                return
+        else:
+            try:
+                socket.create_connection(address, timeout=0.1).close()
+                return
+            except OSError:
+                pass
+        time.sleep(0.05)
+    raise TimeoutError("simulator not ready at {}".format(address))
+
+
+@contextlib.contextmanager
+def simulator(models, transports):
+    """
+    Run the simulator in a separate process (it uses gevent) with one
+    device per model and transport. Yields {(model, transport): url}
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        devices, urls, ready = [], {}, []
+        for model in models:
+            for transport in transports:
+                name = "{}-{}".format(model, transport)
+                if transport == "tcp":
+                    port = free_port()
+                    url = "localhost:{}".format(port)
+                    urls[model, transport] = "tcp://" + url
+                    ready.append(("tcp", ("localhost", port)))
+                else:
+                    url = os.path.join(tmp, name)
+                    urls[model, transport] = "serial://" + url
+                    ready.append(("serial", url))
+                devices.append({
+                    "name": name,
+                    "class": "Julabo" + model,
+                    "package": "julabo.simulator",
+                    "transports": [{"type": transport, "url": url}],
+                })
+        config = os.path.join(tmp, "simulator.json")
+        with open(config, "w") as fobj:
+            json.dump({"devices": devices}, fobj)
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        process = subprocess.Popen(
+            [sys.executable, "-m", "sinstruments", "-c", config],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            for kind, address in ready:
+                wait_ready(kind, address)
+            yield urls
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def stats(durations):
+    """Latency statistics (in ms) of the given durations (in s)"""
+    durations = sorted(durations)
+    n = len(durations)
+
+    def percentile(p):
+        return 1000 * durations[min(n - 1, int(p / 100 * n))]
+
+    return {
+        "count": n,
+        "min": 1000 * durations[0],
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": 1000 * durations[-1],
+        "mean": 1000 * sum(durations) / n,
+    }
+
+
+def roundtrip_async(url, klass, count, profile):
+    async def run():
+        conn = connection_for_url(url, concurrency="asyncio")
+        dev = klass(conn)
+        if profile is not None:
+            dev.protocol.latency.profile = profile
+        try:
+            await dev.bath_temperature()  # warm up (opens the connection)
+            durations = []
+            start = time.perf_counter()
+            for _ in range(count):
+                t0 = time.perf_counter()
+                await dev.bath_temperature()
+                durations.append(time.perf_counter() - t0)
+            total = time.perf_counter() - start
+        finally:
+            await conn.close()
+        return dict(stats(durations), qps=count / total)
+    return asyncio.run(run())
+
+
+def roundtrip_sync(url, klass, count, profile):
+    conn = connection_for_url(url, concurrency="syncio")
+    dev = klass(conn)
+    if profile is not None:
+        dev.protocol.latency.profile = profile
+    try:
+        dev.bath_temperature()  # warm up (opens the connection)
+        durations = []
+        start = time.perf_counter()
+        for _ in range(count):
+            t0 = time.perf_counter()
+            dev.bath_temperature()
+            durations.append(time.perf_counter() - t0)
+        total = time.perf_counter() - start
+    finally:
+        conn.close()
+    return dict(stats(durations), qps=count / total)
+
+
+def roundtrips(urls, count):
+    results = {}
+    for (model, transport), url in urls.items():
+        klass = MODELS[model]
+        for latency, profile in (("nominal", None), ("zero", ZERO_LATENCY)):
+            for mode, func in (("asyncio", roundtrip_async), ("sync", roundtrip_sync)):
+                key = "/".join((model, transport, mode, latency))
+                print("roundtrip", key, end=" ", flush=True)
+                try:
+                    results[key] = func(url, klass, count, profile)
+                except Exception as error:
+                    results[key] = {"error": repr(error)}
+                    print("ERROR", repr(error))
+                    continue
+                print("p50={p50:.3f}ms p99={p99:.3f}ms qps={qps:.0f}".format(
+                    **results[key]))
+    return results
+
+
+class AIOLoopback:
+    """Connection which replies immediately (no I/O)"""
+
+    is_open = True
+
+    async def write(self, data):
+        pass
+
+    async def write_readline(self, data):
+        return REPLY
+
+    async def reset_input_buffer(self):
+        pass
+
+
+class IOLoopback:
+    """Connection which replies immediately (no I/O)"""
+
+    is_open = True
+
+    def write(self, data):
+        pass
+
+    def write_readline(self, data):
+        return REPLY
+
+    def reset_input_buffer(self):
+        pass
+
+
+def loopback_device(conn, **kwargs):
+    dev = JulaboCF(conn, **kwargs)
+    dev.protocol.latency.profile = ZERO_LATENCY
+    return dev
+
+
+def per_call(func, count):
+    """Mean time (us) of a synchronous call"""
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return 1e6 * (time.perf_counter() - start) / count
+
+
+def per_await(func, count):
+    """Mean time (us) of a coroutine call"""
+    async def run():
+        start = time.perf_counter()
+        for _ in range(count):
+            await func()
+        return 1e6 * (time.perf_counter() - start) / count
+    return run
+
+
+async def lock_cost(lock, count):
+    """Mean time (us) of an uncontended asyncio lock acquire/release"""
+    start = time.perf_counter()
+    for _ in range(count):
+        async with lock():
+            pass
+    return 1e6 * (time.perf_counter() - start) / count
+
+
+def layers(count):
+    """Cost (us per call) of each layer measured without any I/O"""
+    request = b"IN_PV_00\r"
+    results = {
+        "encode": per_call(lambda: encode("IN_PV_00"), count),
+        "clean": per_call(lambda: clean(REPLY), count),
+        "decode": per_call(lambda: decode(REPLY), count),
+        "parse_float": per_call(lambda: float(clean(REPLY)), count),
+    }
+
+    async def run():
+        conn = AIOLoopback()
+        dev = loopback_device(conn)
+        protocol = dev.protocol
+        lock = protocol._lock
+        return {
+            "asyncio.connection": await per_await(
+                lambda: conn.write_readline(request), count)(),
+            "asyncio.lock": await lock_cost(lock, count),
+            "asyncio.back_pressure": await per_await(protocol._back_pressure, count)(),
+            "asyncio.protocol_query": await per_await(
+                lambda: protocol.query(request), count)(),
+            "asyncio.member": await per_await(dev.bath_temperature, count)(),
+            "asyncio.member_with_metrics": await per_await(
+                loopback_device(AIOLoopback(), metrics=True).bath_temperature, count)(),
+        }
+
+    results.update(asyncio.run(run()))
+
+    conn = IOLoopback()
+    dev = loopback_device(conn)
+    protocol = dev.protocol
+    lock = protocol._lock
+
+    def lock_cycle():
+        with lock():
+            pass
+
+    results.update({
+        "sync.connection": per_call(lambda: conn.write_readline(request), count),
+        "sync.lock": per_call(lock_cycle, count),
+        "sync.back_pressure": per_call(protocol._back_pressure, count),
+        "sync.protocol_query": per_call(lambda: protocol.query(request), count),
+        "sync.member": per_call(dev.bath_temperature, count),
+        "sync.member_with_metrics": per_call(
+            loopback_device(IOLoopback(), metrics=True).bath_temperature, count),
+    })
+    for mode in ("asyncio", "sync"):
+        # cost added by each layer on top of the one below
+        results[mode + ".protocol_overhead"] = (
+            results[mode + ".protocol_query"] - results[mode + ".connection"]
+        )
+        results[mode + ".member_overhead"] = (
+            results[mode + ".member"] - results[mode + ".protocol_query"]
+        )
+    for key in sorted(results):
+        print("layer {:<28} {:8.3f} us".format(key, results[key]))
+    return results
+
+
+def metadata():
+    return {
+        "julabo": julabo.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def flatten(data, prefix=""):
+    result = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            result.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)):
+            result[prefix + key] = value
+    return result
+
+
+def compare(old_file, new_file):
+    with open(old_file) as fobj:
+        old = flatten(json.load(fobj))
+    with open(new_file) as fobj:
+        new = flatten(json.load(fobj))
+    print("{:<56} {:>12} {:>12} {:>8}".format("metric", "old", "new", "new/old"))
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key] / old[key] if old[key] else float("nan")
+        print("{:<56} {:>12.3f} {:>12.3f} {:>8.2f}".format(
+            key, old[key], new[key], ratio))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--models", nargs="+", default=list(MODELS),
+                        choices=list(MODELS))
+    parser.add_argument("--transports", nargs="+", default=list(TRANSPORTS),
+                        choices=TRANSPORTS)
+    parser.add_argument("--count", type=int, default=200,
+                        help="queries per round trip benchmark")
+    parser.add_argument("--layer-count", type=int, default=20000,
+                        help="calls per layer benchmark")
+    parser.add_argument("--skip-layers", action="store_true")
+    parser.add_argument("--skip-roundtrip", action="store_true")
+    parser.add_argument("-o", "--output", help="JSON result file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two result files")
+    options = parser.parse_args(args)
+
+    if options.compare:
+        compare(*options.compare)
+        return
+
+    results = {"meta": metadata()}
+    if not options.skip_layers:
+        results["layers"] = layers(options.layer_count)
+    if not options.skip_roundtrip:
+        with simulator(options.models, options.transports) as urls:
+            results["roundtrip"] = roundtrips(urls, options.count)
+    if options.output:
+        with open(options.output, "w") as fobj:
+            json.dump(results, fobj, indent=2)
+        print("results saved to", options.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,18 @@
+from .cache import Cache
 from .connection import connection_for_url
-from .protocol import Protocol, protocol_for_url
-from .device import JulaboCF, JulaboHL, JulaboFC, JulaboMS, SelfTunning, ExternalInput, TemperatureControl, ControlMode
+from .metrics import Metrics, MetricsServer
+from .poller import Poller
+from .recorder import Recorder
+from .program import Program, Ramp, Soak, Step
+from .scheduler import Priority
+from .registers import Register, RegisterMap
+from .protocol import Protocol, protocol_for_url, Latency, LatencyProfile
+from .device import (
+    JulaboCF, JulaboHL, JulaboFC, JulaboMS, SelfTunning, ExternalInput,
+    TemperatureControl, ControlMode, ControlDynamics
+)
+from .fleet import JulaboFleet
+from .factory import julabo_for_url, ModelCache
 
 
 __version__ = "2.3.0"
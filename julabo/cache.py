@@ -0,0 +1,109 @@
+import time
+
+
+FOREVER = float("inf")
+
+
+class Cache:
+    """
+    Read cache of register replies with per register policies:
+
+    - VERSION: cached while the connection lives
+    - SP_ and MODE_ registers writable in *registers* (a RegisterMap, set
+      by the device if not given): cached until the matching OUT_ command
+      is written through the same object
+    - other SP_ and MODE_ registers (ex: flow rate, started) and PV_
+      registers: cached for *ttl* seconds
+    - anything else (ex: STATUS): not cached
+    """
+
+    def __init__(self, ttl=0.5, registers=None):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._values = {}
+        self._epoch = 0
+        self.registers = registers
+
+    def __repr__(self):
+        return "{}(ttl={}, hits={}, misses={})".format(
+            type(self).__name__, self.ttl, self.hits, self.misses
+        )
+
+    @property
+    def registers(self):
+        return self._registers
+
+    @registers.setter
+    def registers(self, registers):
+        self._registers = registers
+        self._forever = frozenset(
+            register.request for register in (registers or {}).values()
+            if register.read and register.write
+            and register.mnemonic.startswith(("SP_", "MODE_"))
+            # started/stopped also changes on the device (keypad, alarm)
+            and register.mnemonic != "MODE_05"
+        )
+
+    def policy(self, request):
+        """
+        Time (s) a reply to the given encoded request (ex: b"IN_PV_00\\r")
+        is valid or None if not cacheable
+        """
+        if request == b"VERSION\r" or request in self._forever:
+            return FOREVER
+        elif request.startswith((b"IN_PV_", b"IN_SP_", b"IN_MODE_")):
+            return self.ttl
+
+    def get(self, request):
+        """
+        Returns (hit, value or epoch). On a miss, the epoch must be given to
+        set() so that a reply racing with an invalidation is not stored.
+        """
+        if self.policy(request) is None:
+            return False, self._epoch
+        item = self._values.get(request)
+        if item is not None:
+            value, expire = item
+            if expire > time.monotonic():
+                self.hits += 1
+                return True, value
+            del self._values[request]
+        self.misses += 1
+        return False, self._epoch
+
+    def set(self, request, value, epoch):
+        if epoch != self._epoch:
+            return
+        period = self.policy(request)
+        if period is not None:
+            self._values[request] = value, time.monotonic() + period
+
+    def invalidate(self, command):
+        """Forget the register modified by the given command (ex: "OUT_SP_00 20")"""
+        self._epoch += 1
+        if isinstance(command, str):
+            command = command.encode()
+        register = command.split(None, 1)[0].rstrip(b"\r")
+        if register.startswith(b"OUT_"):
+            register = register[4:]
+        self._values.pop(b"IN_" + register + b"\r", None)
+
+    def clear(self):
+        self._epoch += 1
+        self._values.clear()
+
+
+class StaticCache(Cache):
+    """
+    Caches only the given requests (default: VERSION) while the
+    connection lives
+    """
+
+    def __init__(self, requests=(b"VERSION\r",)):
+        super().__init__()
+        self.requests = frozenset(requests)
+
+    def policy(self, request):
+        if request in self.requests:
+            return FOREVER
@@ -1,5 +1,6 @@
 import io
 import asyncio
+import threading
 import urllib.parse
 
 
@@ -12,6 +13,43 @@ CONCURRENCY_MAP = {
 }
 
 
+def _timeout_errors():
+    # transports raise their own timeout types (subclasses of OSError)
+    errors = [TimeoutError, asyncio.TimeoutError]
+    try:
+        from sockio.common import ConnectionTimeoutError
+        errors.append(ConnectionTimeoutError)
+    except ImportError:
+        pass
+    try:
+        from serial import SerialTimeoutException
+        errors.append(SerialTimeoutException)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+TIMEOUT_ERRORS = _timeout_errors()
+
+
+def is_timeout(error):
+    """True if the error means the device didn't reply in time"""
+    return isinstance(error, TIMEOUT_ERRORS)
+
+
+def is_connection_error(error):
+    """
+    True if the error means the line is gone (EOF, reset, refused):
+    timeouts and any other error leave the connection open
+    """
+    if is_timeout(error):
+        return False
+    if isinstance(error, (ConnectionError, EOFError)):
+        return True
+    # pyserial reports a vanished port (its EOF) as SerialException
+    return type(error).__name__ == "SerialException"
+
+
 class Serial:
 
     def __init__(self, url, *args, **kwargs):
@@ -20,6 +58,10 @@ class Serial:
         kwargs.setdefault("do_not_open", True)
         self.serial = serial.serial_for_url(url, *args, **kwargs)
 
+    @property
+    def is_open(self):
+        return self.serial.is_open
+
     def open(self):
         self.serial.open()
 
@@ -32,17 +74,20 @@ class Serial:
     def write(self, data):
         return self.serial.write(data)
 
+    def reset_input_buffer(self):
+        self.serial.reset_input_buffer()
+
     def readline(self, eol=None):
-        return self.serial.read_until(terminator=eol or self.eol)
+        # positional: pyserial >= 3.5 renamed "terminator" to "expected"
+        return self.serial.read_until(eol or self.eol)
 
     def write_readline(self, data, eol=None):
         self.write(data)
         return self.readline(eol=eol)
 
 
-def connection_for_url(url, *args, **kwargs):
+def _connection_for_url(url, concurrency, *args, **kwargs):
     url_result = urllib.parse.urlparse(url)
-    concurrency = CONCURRENCY_MAP[kwargs.pop("concurrency", "asyncio")]
     scheme = url_result.scheme
     if scheme == "serial":
         # local serial line
@@ -81,3 +126,118 @@ def connection_for_url(url, *args, **kwargs):
     raise RuntimeError(
         "unsupported concurrency model {!r} for {}".format(concurrency, scheme)
     )
+
+
+class _Entry:
+    """Physical connection shared by several SharedConnection handles"""
+
+    def __init__(self, key, connection):
+        self.key = key
+        self.connection = connection
+        self.protocol = None
+        self.refs = 0
+        self.lock = threading.Lock()
+        self.opening = None
+
+
+class SharedConnection:
+    """
+    Handle to a connection shared by all clients of the same URL (see
+    connection_for_url(shared=True)). The physical connection is opened by
+    the first open() and closed when the last handle is closed.
+    Any other attribute is taken from the physical connection.
+
+    The shared protocol uses an uncounted handle: its close() (ex: after
+    a connection error) closes the line for everyone without releasing
+    any reference and the next request reopens it.
+    """
+
+    def __init__(self, entry, counted=True):
+        self.registry_entry = entry
+        self.counted = counted
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self.registry_entry.connection, name)
+
+    def _release(self):
+        if not self.counted:
+            return True
+        if self._closed:
+            return False
+        self._closed = True
+        with _registry_lock:
+            entry = self.registry_entry
+            entry.refs -= 1
+            if entry.refs > 0:
+                return False
+            del _registry[entry.key]
+        return True
+
+
+class AIOSharedConnection(SharedConnection):
+
+    async def open(self):
+        entry = self.registry_entry
+        # concurrent open() calls share the same physical open
+        if entry.opening is None or entry.opening.done():
+            if entry.connection.is_open:
+                return
+            entry.opening = asyncio.ensure_future(entry.connection.open())
+        await asyncio.shield(entry.opening)
+
+    async def close(self):
+        if self._release():
+            await self.registry_entry.connection.close()
+
+
+class IOSharedConnection(SharedConnection):
+
+    def open(self):
+        entry = self.registry_entry
+        with entry.lock:
+            if not entry.connection.is_open:
+                entry.connection.open()
+
+    def close(self):
+        if self._release():
+            self.registry_entry.connection.close()
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def normalize_url(url):
+    """Normalized URL: ex: "TCP://Bridge:5000/" -> "tcp://bridge:5000" """
+    result = urllib.parse.urlparse(url)
+    path = result.path.rstrip("/") if result.netloc else result.path
+    return urllib.parse.urlunparse(
+        result._replace(scheme=result.scheme.lower(),
+                        netloc=result.netloc.lower(), path=path)
+    )
+
+
+def connection_for_url(url, *args, **kwargs):
+    """
+    Create a connection for the given URL.
+
+    With shared=True, all calls for the same (normalized) URL and
+    concurrency return a handle to the same physical connection (and the
+    same Protocol, see julabo.protocol.Protocol). The physical connection is
+    closed when all handles are closed. Extra arguments are only used when
+    the physical connection is created.
+    """
+    concurrency = CONCURRENCY_MAP[kwargs.pop("concurrency", "asyncio")]
+    if not kwargs.pop("shared", False):
+        return _connection_for_url(url, concurrency, *args, **kwargs)
+    key = normalize_url(url), concurrency
+    with _registry_lock:
+        entry = _registry.get(key)
+        if entry is None:
+            connection = _connection_for_url(url, concurrency, *args, **kwargs)
+            entry = _registry[key] = _Entry(key, connection)
+        entry.refs += 1
+    if concurrency == "asyncio":
+        return AIOSharedConnection(entry)
+    return IOSharedConnection(entry)
@@ -1,21 +1,60 @@
-import enum
+import re
 import asyncio
 import logging
-import functools
-
-from .protocol import Protocol
+import concurrent.futures
+
+from . import registers
+from .cache import Cache
+from .registers import (
+    Register, Codec, TEXT, FLOAT1, FLOAT2, INT,
+    SelfTunning, ExternalInput, TemperatureControl, ControlMode, ControlDynamics
+)
+# kept importable from here for backward compatibility
+from .registers import IntEnum, make_encoder  # noqa: F401
+from .scheduler import Priority
+from .protocol import (
+    encode, decode, AIOProtocol, ConnectionState, Protocol, Latency,
+    LATENCY_PROFILES, DEFAULT_LATENCY_PROFILE
+)
 
 
 __all__ = [
     "JulaboCF", "JulaboHL", "JulaboFC", "JulaboMS",
-    "SelfTunning", "ExternalInput", "TemperatureControl", "ControlMode"
+    "SelfTunning", "ExternalInput", "TemperatureControl", "ControlMode",
+    "ControlDynamics", "model_for_version"
 ]
 
 
+# model -> pattern matching the VERSION reply
+MODEL_PATTERNS = {
+    "CF": re.compile(r"\bCF\d*\b|CRYOCOMPACT"),
+    "HL": re.compile(r"\bHL\b|\bHL/"),
+    "MS": re.compile(r"\bMS\b|MAGIO"),
+    "FC": re.compile(r"\bFC\d*\b"),
+}
+
+
+def model_for_version(version):
+    """Model (ex: "CF") from the VERSION reply or None if unknown"""
+    version = version.upper()
+    for model, pattern in MODEL_PATTERNS.items():
+        if pattern.search(version):
+            return model
+
+
 async def _call(func, coro):
     return func(await coro)
 
 
+async def _value(value):
+    return value
+
+
+async def _flush_close(protocol, connection):
+    await protocol.flush()
+    await connection.close()
+
+
 def _sync_call(func, arg):
     if asyncio.iscoroutine(arg):
         return _call(func, arg)
@@ -23,151 +62,351 @@ def _sync_call(func, arg):
         return func(arg)
 
 
-def member(read=None, write=None, decode=lambda x: x, encode=lambda x: x):
+def register_member(register):
+    """
+    Device method for the given Register. The request bytes are computed
+    once here; the reply bytes are decoded directly by the register codec.
+    """
+    request = register.request
+    decode = register.codec.decode
 
-    if read:
-        if write:
+    if register.read:
+        if register.write:
             def member(self, value=None):
                 if value is None:
-                    return _sync_call(decode, self.write_readline(read))
+                    return _sync_call(decode, self.query(request))
                 else:
-                    return self.write("{} {}".format(write, encode(value)))
+                    return self.write(register.command(value))
         else:
             def member(self):
-                return _sync_call(decode, self.write_readline(read))
+                return _sync_call(decode, self.query(request))
     else:
         def member(self, value=None):
             if value is None:
-                return self.write(write)
+                return self.write(register.write)
             else:
-                return self.write("{} {}".format(write, encode(value)))
+                return self.write(register.command(value))
+    if register.name:
+        member.__name__ = register.name
+    member.__doc__ = register.description or None
+    member.register = register
+    member.read = request
+    member.decode = decode
+    member.check = register.codec.check
     return member
 
 
-Float1 = functools.partial(member, decode=float, encode=lambda x: '{:.1f}'.format(float(x)))
-Float2 = functools.partial(member, decode=float, encode=lambda x: '{:.2f}'.format(float(x)))
-Int = functools.partial(member, decode=int, encode=lambda x: str(int(x)))
-
+def _on_text(func):
+    # custom member() callables get the reply text, as they always did
+    def wrapper(reply):
+        return func(TEXT.decode(reply))
+    return wrapper
 
-def Enum(read=None, write=None, enu=None):
-    return member(read=read, write=write, decode=enu.decode, encode=enu.encode)
 
+def member(read=None, write=None, decode=None, encode=str, check=None):
+    """
+    decode: callable converting the reply text to a value (default: text)
+    check: callable which raises ValueError if the given reply text is not
+    a valid reply to *read* (used by the protocol to detect stale replies)
+    """
+    decode = TEXT.decode if decode is None else _on_text(decode)
+    if check is not None:
+        check = _on_text(check)
+    codec = Codec(decode, encode, check)
+    return register_member(Register(None, read, write, codec))
 
-class IntEnum(enum.IntEnum):
 
-    @classmethod
-    def decode(cls, v):
-        return cls(int(v))
+def make_members(klass):
+    """Add a member to klass for each register in klass.REGISTERS"""
+    for name, register in klass.REGISTERS.items():
+        current = getattr(klass, name, None)
+        if getattr(current, "register", None) != register:
+            setattr(klass, name, register_member(register))
 
 
-def make_encoder(klass):
-    def encode(value):
-        if isinstance(value, klass):
-            value = value.value
-        elif isinstance(value, str):
-            try:
-                value = int(value)
-            except ValueError:
-                value = getattr(klass, value.capitalize()).value
-        return str(value)
-    klass.encode = encode
+def is_readable(obj):
+    return callable(obj) and getattr(obj, "read", None) is not None
 
 
-class SelfTunning(IntEnum):
-    Off = 0
-    Once = 1
-    Always = 2
-make_encoder(SelfTunning)
+def Float1(read=None, write=None):
+    return register_member(Register(None, read, write, FLOAT1))
 
 
-class ExternalInput(IntEnum):
-    Voltage = 0
-    Current = 1
-make_encoder(ExternalInput)
+def Float2(read=None, write=None):
+    return register_member(Register(None, read, write, FLOAT2))
 
 
-class TemperatureControl(IntEnum):
-    Internal = 0
-    External = 1
-make_encoder(TemperatureControl)
+def Int(read=None, write=None):
+    return register_member(Register(None, read, write, INT))
 
 
-class ControlMode(IntEnum):
-    Remote = 0
-    Local = 1
-make_encoder(ControlMode)
+def Enum(read=None, write=None, enu=None):
+    return register_member(Register(None, read, write, registers.Enum(enu)))
 
 
 class BaseJulabo:
-
-    def __init__(self, connection):
+    """
+    Base julabo device. Members are generated from the REGISTERS table
+    (see julabo.registers), so models can be introspected with
+    ex: JulaboCF.REGISTERS["bath_temperature"].unit
+    """
+
+    MODEL = None
+    REGISTERS = registers.BASE
+
+    def __init__(self, connection, adaptive_latency=False, queued_writes=False,
+                 cache=False, latency_profile=None, protocol=None, **kwargs):
+        """
+        latency_profile: LatencyProfile (default: the one registered for
+        the model in LATENCY_PROFILES). detect_latency() never replaces it.
+        protocol: protocol already talking to the device through the given
+        connection (ex: the one which read the identification) to use
+        instead of creating one. The latency profile is still applied.
+        Extra keyword arguments are given to the Protocol
+        """
         self._log = logging.getLogger("julabo.{}".format(type(self).__name__))
-        self.protocol = Protocol(connection)
+        self.connection = connection
+        if cache is True:
+            cache = Cache()
+        self.cache = cache or None
+        if self.cache is not None and self.cache.registers is None:
+            self.cache.registers = self.REGISTERS
+        self.latency_profile = latency_profile
+        profile = latency_profile or LATENCY_PROFILES.get(
+            self.MODEL, DEFAULT_LATENCY_PROFILE
+        )
+        if protocol is None:
+            kwargs["latency"] = Latency(profile, adaptive=adaptive_latency)
+            if queued_writes:
+                kwargs["queued"] = True
+            protocol = Protocol(connection, **kwargs)
+        else:
+            protocol.latency.profile = profile
+        self.protocol = protocol
+        self._attach()
+        for name in self.readable_members():
+            obj = getattr(type(self), name)
+            if obj.check is not None:
+                self.protocol.checks[obj.read] = obj.check
+        self._async = isinstance(self.protocol, AIOProtocol)
+
+    def _attach(self):
+        # follow the connection state of the (possibly shared) protocol
+        if self._on_connection_state not in self.protocol.listeners:
+            self.protocol.listeners.append(self._on_connection_state)
+
+    def _detach(self):
+        # stop following a (possibly shared) protocol
+        protocol = self.protocol
+        if self._on_connection_state in protocol.listeners:
+            protocol.listeners.remove(self._on_connection_state)
+
+    def open(self):
+        """Open the connection (through the protocol)"""
+        self._attach()
+        return self.protocol.open()
+
+    def close(self):
+        """
+        Close the connection. With a shared connection only this handle
+        is closed: the line is closed when its last user closes it
+        """
+        self._detach()
+        if self.cache is not None:
+            self.cache.clear()
+        if not hasattr(self.connection, "registry_entry"):
+            return self.protocol.close()
+        # queued commands would reopen the line after the last handle
+        if self._async:
+            return _flush_close(self.protocol, self.connection)
+        self.protocol.flush()
+        return self.connection.close()
+
+    def _on_connection_state(self, state):
+        if state != ConnectionState.OPEN and self.cache is not None:
+            # the next connection may well be to a different device
+            self.cache.clear()
+
+    def detect_latency(self):
+        """
+        Read the device identification and select the latency profile
+        registered for the corresponding model in LATENCY_PROFILES (if
+        any and if no latency_profile was given). Returns the model name
+        """
+        def select(version):
+            model = model_for_version(version)
+            profile = LATENCY_PROFILES.get(model)
+            if model is None:
+                self._log.warning("unknown model %r. Keeping latency", version)
+            elif profile is not None and self.latency_profile is None:
+                self.protocol.latency.profile = profile
+            return model
+        return _sync_call(select, self.identification())
+
+    def write(self, request, priority=Priority.COMMAND):
+        cache = self.cache
+        if cache is None:
+            return self.protocol.write(request, priority)
+        cache.invalidate(request)
+        result = self.protocol.write(request, priority)
+        if isinstance(result, (asyncio.Future, concurrent.futures.Future)):
+            # queued command: a read may have cached the old value meanwhile
+            result.add_done_callback(lambda _: cache.invalidate(request))
+        return result
+
+    def write_at(self, request, deadline, priority=Priority.COMMAND):
+        """Send the command at the given time.monotonic() deadline"""
+        if self.cache is not None:
+            self.cache.invalidate(request)
+        return self.protocol.write_at(request, deadline, priority)
+
+    def query(self, request, priority=Priority.INTERACTIVE):
+        """Query with an encoded request. Returns the reply bytes"""
+        cache = self.cache
+        if cache is None:
+            return self.protocol.query(request, priority)
+        hit, value = cache.get(request)
+        if hit:
+            return _value(value) if self._async else value
+        epoch = value
+
+        def store(reply):
+            cache.set(request, reply, epoch)
+            return reply
+
+        return _sync_call(store, self.protocol.query(request, priority))
+
+    def query_many(self, requests, priority=Priority.INTERACTIVE):
+        """Query several encoded requests. Returns the list of reply bytes"""
+        cache = self.cache
+        if cache is None:
+            return self.protocol.query_many(requests, priority)
+        values, missing, epoch = {}, [], None
+        for request in requests:
+            hit, value = cache.get(request)
+            if hit:
+                values[request] = value
+            else:
+                missing.append(request)
+                epoch = value
 
-    def write(self, request):
-        return self.protocol.write(request)
+        def store(replies):
+            for request, reply in zip(missing, replies):
+                cache.set(request, reply, epoch)
+                values[request] = reply
+            return [values[request] for request in requests]
 
-    def write_readline(self, request):
-        return self.protocol.write_readline(request)
+        if not missing:
+            values = store(())
+            return _value(values) if self._async else values
+        return _sync_call(store, self.protocol.query_many(missing, priority))
 
-    identification = member("VERSION")
-    status = member("STATUS")
+    def write_readline(self, request, priority=Priority.INTERACTIVE):
+        return _sync_call(decode, self.query(encode(request), priority))
 
-    is_started = member("IN_MODE_05", decode=lambda x: x == "1")
+    def write_readlines(self, requests, priority=Priority.INTERACTIVE):
+        requests = [encode(request) for request in requests]
+
+        def decode_all(replies):
+            return [decode(reply) for reply in replies]
+
+        return _sync_call(decode_all, self.query_many(requests, priority))
+
+    @classmethod
+    def readable_members(cls):
+        """Names of all readable members (in order of declaration)"""
+        names = {}
+        for klass in reversed(cls.__mro__):
+            for name, obj in vars(klass).items():
+                if is_readable(obj):
+                    names[name] = None
+                else:
+                    names.pop(name, None)
+        return list(names)
+
+    def read_many(self, *names, priority=Priority.INTERACTIVE):
+        """
+        Read the given members in a single protocol transaction.
+        Registers shared by several members are only queried once.
+        Returns a dict {name: value}
+        """
+        klass = type(self)
+        members = {}
+        for name in names:
+            obj = getattr(klass, name, None)
+            if not is_readable(obj):
+                raise ValueError("{!r} is not a readable member".format(name))
+            members[name] = obj
+        requests = list({obj.read: None for obj in members.values()})
+
+        def decode(replies):
+            replies = dict(zip(requests, replies))
+            return {
+                name: obj.decode(replies[obj.read])
+                for name, obj in members.items()
+            }
+
+        return _sync_call(decode, self.query_many(requests, priority))
+
+    def snapshot(self, names=None, priority=Priority.INTERACTIVE):
+        """
+        Read the given member names (default: all readable members except
+        optional registers) in a single protocol transaction.
+        Returns a dict {name: value}
+        """
+        if names is None:
+            klass = type(self)
+            names = [
+                name for name in self.readable_members()
+                if not getattr(klass, name).register.optional
+            ]
+        return self.read_many(*names, priority=priority)
 
     def start(self):
-        return self.write("OUT_MODE_05 1")
+        return self.write(b"OUT_MODE_05 1\r")
 
     def stop(self):
-        return self.write("OUT_MODE_05 0")
+        return self.write(b"OUT_MODE_05 0\r")
+
+
+make_members(BaseJulabo)
 
 
 class BaseJulaboCirculator(BaseJulabo):
     """Base julabo circulators"""
 
-    bath_temperature = Float2("IN_PV_00")
-    heating_power = Float2("IN_PV_01")
-    external_temperature = Float2("IN_PV_02")
-    safety_temperature = Float2("IN_PV_03")
-    set_point_1 = Float2("IN_SP_00", "OUT_SP_00")
-    set_point_2 = Float2("IN_SP_01", "OUT_SP_01")
-    set_point_3 = Float2("IN_SP_02", "OUT_SP_02")
-    high_temperature = Float2("IN_SP_02", "OUT_SP_02")
-    low_temperature = Float2("IN_SP_03", "OUT_SP_03")
-    active_set_point_channel = member(
-        "IN_MODE_01", "OUT_MODE_01",
-        decode=lambda v: int(v) + 1,
-        encode=lambda v: str(int(v) - 1)
-    )
-    self_tunning = Enum("IN_MODE_02", "OUT_MODE_02", SelfTunning)
-    external_input = Enum("IN_MODE_03", "OUT_MODE_03", ExternalInput)
-    temperature_control = Enum("IN_MODE_04", "OUT_MODE_04", TemperatureControl)
+    REGISTERS = registers.CIRCULATOR
+
+
+make_members(BaseJulaboCirculator)
 
 
 class JulaboCF(BaseJulaboCirculator):
     """Julabo cryo-compact circulator"""
 
+    MODEL = "CF"
+
 
 class JulaboHL(BaseJulaboCirculator):
     """Julabo heating circulator"""
-    pass
+
+    MODEL = "HL"
 
 
 class JulaboMS(BaseJulaboCirculator):
     """Julabo refrigerated/heating circulator"""
-    pass
+
+    MODEL = "MS"
 
 
 class JulaboFC(BaseJulabo):
     """Julabo recirculating cooler"""
 
-    working_temperature = Float1("IN_SP_00", "OUT_SP_00")
-    high_temperature = Int("IN_SP_01")
-    low_temperature = Int("IN_SP_02")
-    control_ratio = Int("IN_SP_03", "OUT_SP_03")
-    feed_temperature = Float2("IN_PV_00")
-    external_emperature = Float2("IN_PV_01")
-    heater_capacity = Float2("IN_PV_02")
-    return_temperature = Float2("IN_PV_03")
-    safety_temperature = Float2("IN_PV_04")
-    control_mode = Enum("IN_MODE_04", "OUT_MODE_04", ControlMode)
+    MODEL = "FC"
+    REGISTERS = registers.FC
+
+    # kept for backward compatibility (misspelled in previous versions)
+    external_emperature = property(lambda self: self.external_temperature)
+
+
+make_members(JulaboFC)
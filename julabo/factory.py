@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import tempfile
+
+from .connection import connection_for_url, normalize_url
+from .device import (
+    BaseJulabo, JulaboCF, JulaboHL, JulaboMS, JulaboFC, model_for_version,
+    _value
+)
+
+
+MODELS = {"CF": JulaboCF, "HL": JulaboHL, "MS": JulaboMS, "FC": JulaboFC}
+
+_log = logging.getLogger("julabo.factory")
+
+
+def default_model_cache_path():
+    base = os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "julabo", "models.json")
+
+
+class ModelCache:
+    """
+    Persistent URL -> model mapping (JSON file, default:
+    ~/.cache/julabo/models.json). Each entry keeps the model, the
+    VERSION reply it was detected from and when.
+    An unreadable file is treated as empty.
+    """
+
+    def __init__(self, path=None):
+        self.path = default_model_cache_path() if path is None else path
+        self._entries = None
+        self._mtime = None
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.path)
+
+    @property
+    def entries(self):
+        # reload only if the file changed (ex: written by another process)
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if self._entries is None or mtime != self._mtime:
+            self._entries = self._load()
+            self._mtime = mtime
+        return self._entries
+
+    def _load(self):
+        try:
+            with open(self.path) as fobj:
+                return dict(json.load(fobj)["devices"])
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            _log.warning("ignoring model cache %r: %r", self.path, error)
+            return {}
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory or ".", exist_ok=True)
+            # write + rename so that readers never see a partial file
+            fd, tmp = tempfile.mkstemp(dir=directory or ".", suffix=".tmp")
+            with os.fdopen(fd, "w") as fobj:
+                json.dump({"devices": self._entries}, fobj, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+        except OSError as error:
+            _log.warning("could not save model cache %r: %r", self.path, error)
+
+    def get(self, url):
+        """Entry {"model", "version", "time"} for the given URL or None"""
+        return self.entries.get(normalize_url(url))
+
+    def set(self, url, model, version):
+        # merge with what other processes may have written meanwhile
+        self._entries = self._load()
+        self._entries[normalize_url(url)] = {
+            "model": model, "version": version, "time": time.time()
+        }
+        self._save()
+
+    def remove(self, url):
+        self._entries = self._load()
+        if self._entries.pop(normalize_url(url), None) is not None:
+            self._save()
+
+
+_model_caches = {}
+
+
+def _model_cache(model_cache):
+    if model_cache is True:
+        model_cache = default_model_cache_path()
+    if isinstance(model_cache, str):
+        cache = _model_caches.get(model_cache)
+        if cache is None:
+            cache = _model_caches[model_cache] = ModelCache(model_cache)
+        return cache
+    return model_cache or None
+
+
+def _validate(device, url, cache, model):
+    """
+    Check the cached model against the VERSION replies the device gets
+    anyway (ex: identification(), detect_latency()). No extra request is
+    made. On a mismatch the cache is updated once, outside the reply path
+    """
+    def check(reply):
+        version = reply.decode().strip()
+        found = model_for_version(version)
+        if found is None or found == model:
+            return
+        # checked once: the device keeps its class until created again
+        device.protocol.reply_hooks.pop(b"VERSION\r", None)
+        device.detected_model = found
+        _log.error(
+            "%s: cached model %s but device reports %r. Model cache "
+            "updated: create the device again", url, model, version
+        )
+        if device._async:
+            loop = asyncio.get_event_loop()
+            loop.run_in_executor(None, cache.set, url, found, version)
+        else:
+            cache.set(url, found, version)
+
+    device.detected_model = model
+    device.protocol.reply_hooks[b"VERSION\r"] = check
+
+
+async def _probe_async(probe, create):
+    try:
+        return create(await probe.identification())
+    except BaseException:
+        # also when cancelled (ex: asyncio.wait_for timeout)
+        try:
+            await probe.close()
+        except Exception as error:
+            _log.warning("could not close %r: %r", probe.connection, error)
+        raise
+
+
+def _probe_sync(probe, create):
+    try:
+        return create(probe.identification())
+    except BaseException:
+        try:
+            probe.close()
+        except Exception as error:
+            _log.warning("could not close %r: %r", probe.connection, error)
+        raise
+
+
+def julabo_for_url(url, concurrency="asyncio", model_cache=True, default=None,
+                   connection_options=None, **kwargs):
+    """
+    Create the julabo device of the right model for the given URL.
+
+    The model is detected from the VERSION reply and stored in the
+    model cache (a ModelCache, a path or True for the default one) so
+    that next time the device is created without any communication.
+    A cached model is validated against the VERSION replies the device
+    gets later on (no extra request is made).
+    Devices not recognized get the *default* class (ValueError if None).
+
+    connection_options are given to connection_for_url and the remaining
+    keyword arguments to the device class.
+    With asyncio, returns a coroutine::
+
+        dev = await julabo_for_url("tcp://bridge-01:5000")
+    """
+    connection = connection_for_url(
+        url, concurrency=concurrency, **(connection_options or {})
+    )
+    cache = _model_cache(model_cache)
+    entry = None if cache is None else cache.get(url)
+    if entry is not None and entry.get("model") in MODELS:
+        model = entry["model"]
+        device = MODELS[model](connection, **kwargs)
+        _validate(device, url, cache, model)
+        return _value(device) if device._async else device
+
+    def create(version):
+        model = model_for_version(version)
+        klass = MODELS.get(model, default)
+        if klass is None:
+            raise ValueError("unknown julabo model {!r}".format(version))
+        if cache is not None and model is not None:
+            cache.set(url, model, version)
+        # same protocol: it knows when VERSION was sent (latency)
+        device = klass(connection, protocol=probe.protocol, **kwargs)
+        device.detected_model = model
+        return device
+
+    options = dict(kwargs)
+    options.pop("cache", None)
+    probe = BaseJulabo(connection, **options)
+    # only used to read the identification
+    probe._detach()
+    if probe._async:
+        return _probe_async(probe, create)
+    return _probe_sync(probe, create)
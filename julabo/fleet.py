@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import functools
+
+from .connection import connection_for_url
+from .device import JulaboCF
+
+
+class JulaboFleet:
+    """
+    Many asyncio julabo devices driven concurrently from a single event loop.
+
+    Every fleet operation runs on all (or the given) devices at the same
+    time with a per device timeout, so one dead bridge never stalls the
+    rest. Results are dicts {device name: value}, where value is the
+    exception instance if the operation failed on that device.
+
+    Example::
+
+        fleet = JulaboFleet({
+            "hall-01": "tcp://bridge-01:5000",
+            "hall-02": ("tcp://bridge-02:5000", JulaboHL),
+        })
+        async with fleet:
+            values = await fleet.snapshot(["bath_temperature", "status"])
+            await fleet.set_point(22.5)
+    """
+
+    def __init__(self, urls, Julabo=JulaboCF, timeout=1.0, max_parallel=16,
+                 **kwargs):
+        self.timeout = timeout
+        self.max_parallel = max_parallel
+        self.connections = {}
+        self.devices = {}
+        self._log = logging.getLogger("julabo.{}".format(type(self).__name__))
+        for name, url in urls.items():
+            klass = Julabo
+            if not isinstance(url, str):
+                url, klass = url
+            connection = connection_for_url(url, concurrency="asyncio")
+            self.connections[name] = connection
+            self.devices[name] = klass(connection, **kwargs)
+
+    def __getitem__(self, name):
+        return self.devices[name]
+
+    def __len__(self):
+        return len(self.devices)
+
+    async def _call(self, name, func, semaphore=None):
+        try:
+            if semaphore is None:
+                return await asyncio.wait_for(func(), self.timeout)
+            async with semaphore:
+                return await asyncio.wait_for(func(), self.timeout)
+        except Exception as error:
+            self._log.debug("%s: %r", name, error)
+            return error
+
+    async def _gather(self, calls, max_parallel=None):
+        semaphore = None if max_parallel is None else asyncio.Semaphore(max_parallel)
+        results = await asyncio.gather(
+            *(self._call(name, func, semaphore) for name, func in calls.items())
+        )
+        return dict(zip(calls, results))
+
+    async def gather(self, func, names=None, max_parallel=None):
+        """
+        Run func(device) coroutine on the given devices (default: all)
+        concurrently. Returns {name: result or exception}
+        """
+        names = self.devices if names is None else names
+        calls = {
+            name: functools.partial(func, self.devices[name]) for name in names
+        }
+        return await self._gather(calls, max_parallel=max_parallel)
+
+    async def open(self, names=None):
+        """Open the connections (at most max_parallel at the same time)"""
+        return await self.gather(
+            lambda device: device.open(), names, max_parallel=self.max_parallel
+        )
+
+    async def close(self, names=None):
+        return await self.gather(lambda device: device.close(), names)
+
+    async def snapshot(self, members=None, names=None):
+        """
+        Read the given members (default: all readable except optional
+        registers) from every device
+        """
+        return await self.gather(lambda device: device.snapshot(members), names)
+
+    async def start(self, names=None):
+        return await self.gather(lambda device: device.start(), names)
+
+    async def stop(self, names=None):
+        return await self.gather(lambda device: device.stop(), names)
+
+    async def set_point(self, value, member="set_point_1", names=None):
+        """
+        Write the given set point on the devices. value is either a single
+        value for the given devices (default: all) or a dict {name: value}
+        """
+        if isinstance(value, dict):
+            values = value
+        else:
+            names = self.devices if names is None else names
+            values = dict.fromkeys(names, value)
+        calls = {
+            name: functools.partial(getattr(self.devices[name], member), value)
+            for name, value in values.items()
+        }
+        return await self._gather(calls)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.close()
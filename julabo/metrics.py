@@ -0,0 +1,263 @@
+import bisect
+import threading
+import http.server
+import socketserver
+
+from .connection import is_timeout, is_connection_error
+
+
+# round trip time buckets (s). Nominal query latency alone is 10ms
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+
+
+class Histogram:
+    """Fixed buckets histogram (counts are not cumulative)"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def __repr__(self):
+        return "{}(count={}, mean={:.6f})".format(
+            type(self).__name__, self.count, self.mean
+        )
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """
+        Estimated q-th percentile (0-100), interpolated inside the bucket
+        (values beyond the last bucket report its bound)
+        """
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        total, lower = 0, 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and total + count >= rank:
+                return lower + (bound - lower) * max(rank - total, 0) / count
+            total += count
+            lower = bound
+        return self.buckets[-1]
+
+    def cumulative(self):
+        """[(upper bound, cumulative count)] including +Inf"""
+        result, total = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """
+    Protocol metrics. Give it to the protocol (ex: JulaboCF(conn,
+    metrics=Metrics())) to enable collection. Without it, the protocol
+    only pays an "is None" test per request.
+
+    - latency: {request: Histogram} of query round trip times per register
+    - back_pressure: total time (s) and count of latency sleeps
+    - timeouts, decode_errors (unexpected replies), connection_errors
+    - bytes_in, bytes_out, queries, commands, resyncs
+    - wait_stats: lock wait time per Priority (set by the protocol)
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.latency = {}
+        self.back_pressure_time = 0.0
+        self.back_pressure_count = 0
+        self.timeouts = 0
+        self.decode_errors = 0
+        self.connection_errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.queries = 0
+        self.commands = 0
+        self.resyncs = 0
+        self.wait_stats = {}
+
+    def query(self, request, reply, duration):
+        histogram = self.latency.get(request)
+        if histogram is None:
+            histogram = self.latency[request] = Histogram(self.buckets)
+        histogram.observe(duration)
+        self.queries += 1
+        self.bytes_out += len(request)
+        self.bytes_in += len(reply)
+
+    def command(self, data):
+        self.commands += 1
+        self.bytes_out += len(data)
+
+    def back_pressure(self, wait):
+        self.back_pressure_time += wait
+        self.back_pressure_count += 1
+
+    def error(self, error):
+        if is_timeout(error):
+            self.timeouts += 1
+        elif is_connection_error(error):
+            self.connection_errors += 1
+
+    def snapshot(self):
+        """All metrics as a dict"""
+        return {
+            "latency": {
+                request.decode().strip(): {
+                    "count": hist.count, "sum": hist.sum, "mean": hist.mean,
+                    "buckets": hist.cumulative(),
+                }
+                for request, hist in self.latency.items()
+            },
+            "back_pressure_time": self.back_pressure_time,
+            "back_pressure_count": self.back_pressure_count,
+            "lock_wait": {
+                priority.name: {
+                    "count": stats.count, "total": stats.total, "max": stats.max
+                }
+                for priority, stats in self.wait_stats.items()
+            },
+            "timeouts": self.timeouts,
+            "decode_errors": self.decode_errors,
+            "connection_errors": self.connection_errors,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "queries": self.queries,
+            "commands": self.commands,
+            "resyncs": self.resyncs,
+        }
+
+    def prometheus(self):
+        """Metrics in Prometheus text exposition format"""
+        return prometheus_text({None: self})
+
+
+COUNTERS = (
+    ("julabo_back_pressure_seconds_total", "Time spent waiting for the device latency",
+     lambda m: m.back_pressure_time),
+    ("julabo_back_pressure_total", "Requests delayed by the device latency",
+     lambda m: m.back_pressure_count),
+    ("julabo_timeouts_total", "Requests without reply", lambda m: m.timeouts),
+    ("julabo_decode_errors_total", "Unexpected replies", lambda m: m.decode_errors),
+    ("julabo_connection_errors_total", "Connection errors",
+     lambda m: m.connection_errors),
+    ("julabo_received_bytes_total", "Bytes received", lambda m: m.bytes_in),
+    ("julabo_sent_bytes_total", "Bytes sent", lambda m: m.bytes_out),
+    ("julabo_queries_total", "Queries", lambda m: m.queries),
+    ("julabo_commands_total", "Commands", lambda m: m.commands),
+    ("julabo_resyncs_total", "Protocol resynchronizations", lambda m: m.resyncs),
+)
+
+
+def _labels(**labels):
+    items = ",".join(
+        '{}="{}"'.format(key, value)
+        for key, value in labels.items() if value is not None
+    )
+    return "{" + items + "}" if items else ""
+
+
+def prometheus_text(metrics):
+    """Prometheus text exposition of {device name: Metrics}"""
+    lines = [
+        "# HELP julabo_query_duration_seconds Query round trip time",
+        "# TYPE julabo_query_duration_seconds histogram",
+    ]
+    for device, metric in metrics.items():
+        for request, hist in list(metric.latency.items()):
+            register = request.decode().strip()
+            for bound, count in hist.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("julabo_query_duration_seconds_bucket{} {}".format(
+                    _labels(device=device, register=register, le=le), count))
+            labels = _labels(device=device, register=register)
+            lines.append("julabo_query_duration_seconds_sum{} {}".format(
+                labels, hist.sum))
+            lines.append("julabo_query_duration_seconds_count{} {}".format(
+                labels, hist.count))
+    for name, doc, get in COUNTERS:
+        lines.append("# HELP {} {}".format(name, doc))
+        lines.append("# TYPE {} counter".format(name))
+        for device, metric in metrics.items():
+            lines.append("{}{} {}".format(name, _labels(device=device), get(metric)))
+    for suffix, doc, field in (
+        ("seconds_total", "Time spent waiting for the communication lock", "total"),
+        ("total", "Requests which waited for the communication lock", "count"),
+    ):
+        name = "julabo_lock_wait_" + suffix
+        lines.append("# HELP {} {}".format(name, doc))
+        lines.append("# TYPE {} counter".format(name))
+        for device, metric in metrics.items():
+            for priority, stats in metric.wait_stats.items():
+                labels = _labels(device=device, priority=priority.name)
+                lines.append("{}{} {}".format(name, labels, getattr(stats, field)))
+    return "\n".join(lines) + "\n"
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+    """
+    Serves the given {device name: Metrics} in Prometheus text format
+    (GET /metrics) from a background thread.
+    """
+
+    def __init__(self, metrics, host="127.0.0.1", port=9100):
+        self.metrics = metrics
+        self.address = host, port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = prometheus_text(metrics).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _HTTPServer(self.address, Handler)
+        self.address = self._server.server_address
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="JulaboMetrics", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
@@ -0,0 +1,328 @@
+"""
+Stream julabo registers from one or many devices as JSON lines or CSV.
+
+Each device is read in a loop as fast as its protocol latency permits
+(or every --period seconds), all devices concurrently from one asyncio
+event loop. Rows go through a bounded queue to a single writer, so a
+slow output slows acquisition down instead of growing memory. On exit
+(Ctrl-C, SIGTERM, --duration or --count) a summary with the achieved
+rate and latency percentiles per device is printed on stderr.
+
+Example::
+
+    julabo-monitor tcp://bridge-01:5000 tcp://bridge-02:5000 \\
+        -r bath_temperature set_point_1 --format csv -o run.csv
+"""
+
+import io
+import os
+import csv
+import sys
+import enum
+import json
+import time
+import signal
+import asyncio
+import logging
+import argparse
+
+from .connection import connection_for_url
+from .factory import MODELS, julabo_for_url
+from .metrics import Histogram
+
+# round trip time buckets (s): ~12% steps from 0.5ms to 5s
+BUCKETS = tuple(round(0.0005 * 1.25 ** i, 7) for i in range(42))
+
+
+def _json_default(value):
+    if isinstance(value, enum.Enum):
+        return value.name
+    return str(value)
+
+
+def _csv_value(value):
+    return value.name if isinstance(value, enum.Enum) else value
+
+
+class Stats:
+    """Per device acquisition statistics (fixed memory)"""
+
+    def __init__(self):
+        self.latency = Histogram(BUCKETS)
+        self.errors = 0
+        self.max = 0.0
+        self.start = None
+        self.stop = None
+
+    @property
+    def count(self):
+        return self.latency.count
+
+    def observe(self, duration):
+        self.latency.observe(duration)
+        if duration > self.max:
+            self.max = duration
+
+    def summary(self):
+        elapsed = (self.stop or time.monotonic()) - (self.start or time.monotonic())
+        latency = self.latency
+        return {
+            "samples": latency.count,
+            "errors": self.errors,
+            "elapsed": elapsed,
+            "rate": latency.count / elapsed if elapsed > 0 else 0.0,
+            "latency_mean": latency.mean,
+            # bucket interpolation may overshoot the maximum
+            "latency_p50": min(latency.percentile(50), self.max),
+            "latency_p90": min(latency.percentile(90), self.max),
+            "latency_p99": min(latency.percentile(99), self.max),
+            "latency_max": self.max,
+        }
+
+
+class Monitor:
+    """
+    Read *names* from the given {url: device} in a loop and hand each row
+    (timestamp, url, values) to the output through a queue of at most
+    *buffer* rows.
+    """
+
+    def __init__(self, devices, names, output, period=0, count=None,
+                 buffer=1000, error_delay=1.0):
+        self.devices = devices
+        self.names = names
+        self.output = output
+        self.period = period
+        self.count = count
+        self.error_delay = error_delay
+        self.queue = asyncio.Queue(buffer)
+        self.stats = {url: Stats() for url in devices}
+        self._log = logging.getLogger("julabo.{}".format(type(self).__name__))
+
+    async def _acquire(self, url, device):
+        stats, names, queue = self.stats[url], self.names, self.queue
+        stats.start = next_read = time.monotonic()
+        try:
+            while self.count is None or stats.count < self.count:
+                t0 = time.monotonic()
+                try:
+                    values = await device.read_many(*names)
+                except Exception as error:
+                    stats.errors += 1
+                    self._log.error("%s: %r", url, error)
+                    await asyncio.sleep(self.error_delay)
+                    continue
+                stats.observe(time.monotonic() - t0)
+                await queue.put((time.time(), url, values))
+                if self.period:
+                    next_read += self.period
+                    wait = next_read - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    else:
+                        next_read = time.monotonic()
+        finally:
+            stats.stop = time.monotonic()
+
+    async def _write(self):
+        queue, output = self.queue, self.output
+        while True:
+            rows = [await queue.get()]
+            # write everything already queued in one go
+            while not queue.empty():
+                rows.append(queue.get_nowait())
+            try:
+                output.write_rows(rows)
+            finally:
+                for _ in rows:
+                    queue.task_done()
+
+    async def run(self):
+        writer = asyncio.ensure_future(self._write())
+        acquire = asyncio.ensure_future(asyncio.gather(
+            *(self._acquire(url, device) for url, device in self.devices.items())
+        ))
+        try:
+            await asyncio.wait((writer, acquire), return_when=asyncio.FIRST_COMPLETED)
+            if writer.done():
+                # output failed (ex: broken pipe)
+                writer.result()
+            await acquire
+            await self.queue.join()
+        finally:
+            acquire.cancel()
+            writer.cancel()
+            await asyncio.gather(acquire, writer, return_exceptions=True)
+            self.output.flush()
+
+    def summary(self):
+        return {url: stats.summary() for url, stats in self.stats.items()}
+
+
+class JSONLines:
+    def __init__(self, file, names):
+        self.file = file
+        self.names = names
+        self._encode = json.JSONEncoder(default=_json_default).encode
+
+    def write_rows(self, rows):
+        encode = self._encode
+        lines = []
+        for timestamp, url, values in rows:
+            lines.append(encode(dict(timestamp=timestamp, device=url, **values)))
+        lines.append("")
+        self.file.write("\n".join(lines))
+        self.file.flush()
+
+    def flush(self):
+        self.file.flush()
+
+
+class CSV:
+    def __init__(self, file, names):
+        self.file = file
+        self.names = names
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._writer.writerow(("timestamp", "device") + tuple(names))
+
+    def write_rows(self, rows):
+        names = self.names
+        self._writer.writerows(
+            [timestamp, url] + [_csv_value(values[name]) for name in names]
+            for timestamp, url, values in rows
+        )
+        self.file.write(self._buffer.getvalue())
+        self.file.flush()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+    def flush(self):
+        self.file.flush()
+
+
+FORMATS = {"jsonl": JSONLines, "csv": CSV}
+
+
+async def create_devices(urls, model, timeout):
+    """{url: device} of the devices which could be created (concurrently)"""
+    log = logging.getLogger("julabo.monitor")
+
+    async def create(url):
+        try:
+            if model == "auto":
+                return await asyncio.wait_for(julabo_for_url(url), timeout)
+            return MODELS[model](connection_for_url(url, concurrency="asyncio"))
+        except Exception as error:
+            log.error("%s: could not create device: %r", url, error)
+
+    devices = await asyncio.gather(*(create(url) for url in urls))
+    return {url: device for url, device in zip(urls, devices) if device is not None}
+
+
+def print_summary(summary, file=sys.stderr):
+    fmt = "{:<32} {:>9} {:>7} {:>9} {:>8} {:>8} {:>8} {:>8}"
+    print(fmt.format("device", "samples", "errors", "rate(Hz)", "p50(ms)",
+                     "p90(ms)", "p99(ms)", "max(ms)"), file=file)
+    for url, stats in summary.items():
+        print(fmt.format(
+            url, stats["samples"], stats["errors"], "{:.1f}".format(stats["rate"]),
+            *("{:.2f}".format(1000 * stats[key]) for key in
+              ("latency_p50", "latency_p90", "latency_p99", "latency_max"))
+        ), file=file)
+
+
+async def monitor(options, output):
+    devices = await create_devices(options.urls, options.model, options.timeout)
+    if not devices:
+        return {}
+    names = options.registers
+    for url, device in list(devices.items()):
+        readable = device.readable_members()
+        missing = [name for name in names if name not in readable]
+        if missing:
+            # ex: auto detected model without the register
+            logging.getLogger("julabo.monitor").error(
+                "%s: %s has no %s", url, type(device).__name__, ", ".join(missing)
+            )
+            del devices[url]
+            await device.close()
+    if not devices:
+        return {}
+    mon = Monitor(
+        devices, names, FORMATS[options.format](output, names),
+        options.period, options.count, options.buffer,
+    )
+    task = asyncio.ensure_future(mon.run())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, task.cancel)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        await asyncio.wait_for(task, options.duration)
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+        pass
+    except BrokenPipeError:
+        # output closed (ex: piped to head): stop quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), output.fileno())
+    finally:
+        for device in devices.values():
+            try:
+                await device.close()
+            except Exception:
+                pass
+    return mon.summary()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("urls", nargs="+",
+                        help="device URLs (ex: tcp://bridge-01:5000)")
+    parser.add_argument("-r", "--registers", nargs="+", default=["bath_temperature"],
+                        help="members to read (default: bath_temperature)")
+    parser.add_argument("-f", "--format", default="jsonl", choices=list(FORMATS))
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    parser.add_argument("--model", default="auto", choices=["auto"] + list(MODELS),
+                        help="device model (default: auto detect)")
+    parser.add_argument("--period", type=float, default=0,
+                        help="read period (s) (default: 0, as fast as possible)")
+    parser.add_argument("--duration", type=float, help="stop after (s)")
+    parser.add_argument("--count", type=int, help="stop after samples per device")
+    parser.add_argument("--buffer", type=int, default=1000,
+                        help="max rows waiting to be written")
+    parser.add_argument("--timeout", type=float, default=5,
+                        help="detection timeout (s)")
+    parser.add_argument("--summary", choices=["text", "json", "none"], default="text")
+    parser.add_argument("--log-level", default="WARNING")
+    options = parser.parse_args(args)
+    models = MODELS.values() if options.model == "auto" else [MODELS[options.model]]
+    readable = {name for klass in models for name in klass.readable_members()}
+    unknown = [name for name in options.registers if name not in readable]
+    if unknown:
+        parser.error("unknown register(s): {}".format(", ".join(unknown)))
+    fmt = "%(asctime)-15s %(levelname)-5s %(name)s: %(message)s"
+    logging.basicConfig(format=fmt, level=options.log_level.upper())
+
+    if options.output is None:
+        output = sys.stdout
+    else:
+        output = open(options.output, "w", newline="")
+    try:
+        summary = asyncio.run(monitor(options, output))
+    except KeyboardInterrupt:
+        summary = {}
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    if options.summary == "json":
+        json.dump(summary, sys.stderr, indent=1)
+        print(file=sys.stderr)
+    elif options.summary == "text":
+        print_summary(summary)
+    return 0 if summary else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
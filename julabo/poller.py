@@ -0,0 +1,161 @@
+import time
+import asyncio
+import logging
+import collections
+
+from .scheduler import Priority
+
+
+Sample = collections.namedtuple("Sample", "name value timestamp")
+
+
+class Subscription:
+    """
+    Async iterator over the samples of a Poller.
+
+    The queue is bounded: if the consumer is too slow the oldest samples
+    are dropped (see *dropped*).
+    """
+
+    _END = object()
+
+    def __init__(self, poller, names=None, maxsize=1000):
+        self.poller = poller
+        self.names = None if names is None else set(names)
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, sample):
+        if self.names is not None and sample.name not in self.names:
+            return
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(sample)
+
+    def close(self):
+        self.poller.unsubscribe(self)
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(self._END)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        sample = await self.queue.get()
+        if sample is self._END:
+            raise StopAsyncIteration
+        return sample
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class Poller:
+    """
+    Cyclically reads members of an asyncio BaseJulabo, each with its own
+    period, and dispatches the values to any number of callbacks and
+    subscriptions. All members due at the same time are read in a single
+    protocol transaction.
+
+    Example::
+
+        poller = Poller(dev, {"bath_temperature": 0.5, "status": 5})
+        poller.add_callback(print)
+        async with poller:
+            async for sample in poller.subscribe(["bath_temperature"]):
+                print(sample.name, sample.value)
+    """
+
+    def __init__(self, device, periods, window=0.01, priority=Priority.BACKGROUND):
+        if not device._async:
+            raise TypeError("Poller requires an asyncio device")
+        if not periods:
+            raise ValueError("Poller requires at least one member to poll")
+        self.device = device
+        self.periods = dict(periods)
+        self.window = window
+        self.priority = priority
+        self.values = {}
+        self.callbacks = []
+        self.subscriptions = []
+        self._task = None
+        self._log = logging.getLogger("julabo.{}".format(type(self).__name__))
+
+    def add_callback(self, callback):
+        """callback(sample) called for each new sample"""
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def subscribe(self, names=None, maxsize=1000):
+        """Returns an async iterator of samples for the given names (default: all)"""
+        subscription = Subscription(self, names=names, maxsize=maxsize)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+    def _dispatch(self, sample):
+        self.values[sample.name] = sample
+        for callback in self.callbacks:
+            try:
+                callback(sample)
+            except Exception:
+                self._log.exception("error in callback %r", callback)
+        for subscription in self.subscriptions:
+            subscription.put(sample)
+
+    async def poll(self, names):
+        """Read the given names once and dispatch the values"""
+        values = await self.device.read_many(*names, priority=self.priority)
+        timestamp = time.time()
+        for name, value in values.items():
+            self._dispatch(Sample(name, value, timestamp))
+        return values
+
+    async def _run(self):
+        now = time.monotonic()
+        due = {name: now for name in self.periods}
+        while True:
+            now = time.monotonic()
+            names = [name for name, t in due.items() if t <= now + self.window]
+            if names:
+                try:
+                    await self.poll(names)
+                except Exception as error:
+                    self._log.error("error polling %s: %r", names, error)
+                now = time.monotonic()
+                for name in names:
+                    # keep the phase but never try to catch up missed cycles
+                    due[name] = max(due[name] + self.periods[name], now)
+            await asyncio.sleep(max(min(due.values()) - now, 0))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        for subscription in list(self.subscriptions):
+            subscription.close()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.stop()
@@ -0,0 +1,404 @@
+import math
+import time
+import asyncio
+import logging
+import collections
+
+from .scheduler import Priority
+
+
+# linear set point ramp to target at rate (degC/min) or in duration (s)
+Ramp = collections.namedtuple("Ramp", "target rate duration", defaults=(None, None))
+# hold the set point for duration (s). If band (degC) is given the soak
+# time only starts once the temperature is within band of the set point
+Soak = collections.namedtuple("Soak", "duration band", defaults=(None,))
+# immediate set point change
+Step = collections.namedtuple("Step", "target")
+
+Progress = collections.namedtuple(
+    "Progress",
+    "segment elapsed fraction set_point written temperature error timestamp"
+)
+Write = collections.namedtuple("Write", "deadline sent value")
+
+# set point resolution of the register codecs
+QUANTUM = {"float1": 0.1, "float2": 0.01}
+
+
+def _quantize(value, quantum):
+    return round(round(value / quantum) * quantum, 6)
+
+
+def segment_duration(segment, start):
+    """Nominal duration (s) of a segment starting at the given set point"""
+    if isinstance(segment, Step):
+        return 0.0
+    if isinstance(segment, Soak):
+        return float(segment.duration)
+    if segment.duration is not None:
+        return float(segment.duration)
+    return 60 * abs(segment.target - start) / segment.rate
+
+
+def check_segment(segment):
+    if isinstance(segment, Ramp):
+        if (segment.rate is None) == (segment.duration is None):
+            raise ValueError("Ramp requires either a rate or a duration")
+        if segment.rate is not None and segment.rate <= 0:
+            raise ValueError("Ramp rate must be positive")
+        if segment.duration is not None and segment.duration < 0:
+            raise ValueError("Ramp duration must not be negative")
+    elif isinstance(segment, Soak):
+        if segment.duration < 0:
+            raise ValueError("Soak duration must not be negative")
+    elif not isinstance(segment, Step):
+        raise TypeError("unknown segment {!r}".format(segment))
+
+
+def plan_segment(start, segment, resolution=0.1, min_interval=0.25, quantum=0.01):
+    """
+    Set point writes of a segment starting at the given set point.
+
+    Ramps are approximated by the staircase with the fewest writes
+    which keeps the written set point within half a step of the ideal
+    profile: each write happens when the ideal profile is half way
+    between two steps. Steps are at most *resolution*, unless more
+    writes would be needed than fit at *min_interval* apart.
+
+    Returns (duration, [(time offset, value)])
+    """
+    duration = segment_duration(segment, start)
+    if isinstance(segment, Soak):
+        return duration, []
+    target = segment.target
+    delta = target - start
+    if not delta:
+        return duration, []
+    if duration <= 0:
+        return duration, [(0.0, _quantize(target, quantum))]
+    n = math.ceil(abs(delta) / max(resolution, quantum) - 1e-9)
+    if min_interval:
+        n = min(n, math.floor(duration / min_interval + 1e-9))
+    n = max(n, 1)
+    writes, last = [], _quantize(start, quantum)
+    for k in range(1, n + 1):
+        value = _quantize(start + delta * k / n, quantum)
+        if value != last:
+            writes.append(((k - 0.5) * duration / n, value))
+            last = value
+    return duration, writes
+
+
+def plan(start, segments, resolution=0.1, min_interval=0.25, quantum=0.01):
+    """
+    Nominal set point writes of a whole program (banded soaks are
+    assumed to start immediately). Returns [(time offset, value)]
+    """
+    result, offset = [], 0.0
+    for segment in segments:
+        check_segment(segment)
+        duration, writes = plan_segment(
+            start, segment, resolution, min_interval, quantum
+        )
+        result.extend((offset + t, value) for t, value in writes)
+        offset += duration
+        start = getattr(segment, "target", start)
+    return result
+
+
+class Program:
+    """
+    Temperature program (sequence of Ramp, Soak and Step segments)
+    executed on an asyncio circulator or FC.
+
+    Set point writes are planned per segment (see plan_segment) and each
+    one is sent at its deadline with write_at, which reserves the
+    communication just before. If other requests (ex: a Poller) still
+    make writes later than *tolerance*, the rest of the ramp is planned
+    again with writes further apart. The temperature is sampled every
+    *sample_period* only when the read fits before the next write. Each
+    sample is reported as a Progress to the callbacks with the tracking
+    error (temperature - ideal set point).
+
+    Example::
+
+        program = Program(dev, [Ramp(40, rate=2), Soak(600, band=0.2),
+                                Step(30), Ramp(20, duration=3600)])
+        program.add_callback(print)
+        await program.run()
+        print(program.report())
+    """
+
+    def __init__(self, device, segments, resolution=0.1, set_point=None,
+                 temperature=None, start=None, sample_period=1.0,
+                 min_interval=None, tolerance=0.005):
+        if not device._async:
+            raise TypeError("Program requires an asyncio device")
+        for segment in segments:
+            check_segment(segment)
+        registers = device.REGISTERS
+        if set_point is None:
+            set_point = (
+                "set_point_1" if "set_point_1" in registers
+                else "working_temperature"
+            )
+        if temperature is None:
+            temperature = (
+                "bath_temperature" if "bath_temperature" in registers
+                else "feed_temperature"
+            )
+        self.device = device
+        self.segments = list(segments)
+        self.set_point = set_point
+        self.temperature = temperature
+        self.register = registers[set_point]
+        self.quantum = QUANTUM.get(self.register.codec.name, 0.01)
+        self.resolution = max(resolution, self.quantum)
+        self.start_value = start
+        self.sample_period = sample_period
+        self.min_interval = min_interval
+        self.tolerance = tolerance
+        self.callbacks = []
+        self.writes = []
+        self.progress = None
+        self._task = None
+        self._interval = None
+        self._next_sample = 0.0
+        self._ideal = None
+        self._total = None
+        self._written = None
+        self._error_count = 0
+        self._error_sum2 = 0.0
+        self._error_max = 0.0
+        self._log = logging.getLogger("julabo.{}".format(type(self).__name__))
+
+    def add_callback(self, callback):
+        """callback(progress) called for each temperature sample"""
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def _slot(self):
+        # time taken by one query
+        latency = self.device.protocol.latency
+        return latency.query + (latency.reply_time or latency.query)
+
+    def _min_interval(self):
+        if self.min_interval is not None:
+            return self.min_interval
+        # leave room for one temperature read between writes
+        return self.device.protocol.latency.command + 2 * self._slot()
+
+    def plan(self, start):
+        """
+        Nominal [(time offset, value)] writes when starting at the given
+        set point
+        """
+        return plan(
+            start, self.segments, self.resolution, self._min_interval(),
+            self.quantum
+        )
+
+    @property
+    def duration(self):
+        """Nominal duration (s) once the start set point is known"""
+        return self._total
+
+    def _sample_fits(self, deadline):
+        # would a read now delay the write due at deadline?
+        protocol = self.device.protocol
+        latency = protocol.latency
+        cost = max(protocol._wait_time(), 0) + self._slot()
+        return time.monotonic() + cost + latency.query <= deadline
+
+    async def _sample(self):
+        try:
+            values = await self.device.read_many(
+                self.temperature, priority=Priority.BACKGROUND
+            )
+        except Exception as error:
+            self._log.error("error reading %s: %r", self.temperature, error)
+            return
+        self._report(values[self.temperature])
+
+    def _report(self, temperature):
+        now = time.monotonic()
+        segment, start, origin, target, duration, offset = self._ideal
+        elapsed = now - self._t0
+        if duration > 0:
+            ratio = min(max((now - start) / duration, 0.0), 1.0)
+            ideal = origin + (target - origin) * ratio
+            done = offset + ratio * duration
+        else:
+            ideal, done = target, offset
+        error = temperature - ideal
+        self._error_count += 1
+        self._error_sum2 += error * error
+        self._error_max = max(self._error_max, abs(error))
+        fraction = min(done / self._total, 1.0) if self._total else 1.0
+        self.progress = Progress(
+            segment, elapsed, fraction, ideal, self._written, temperature, error,
+            time.time()
+        )
+        for callback in self.callbacks:
+            try:
+                callback(self.progress)
+            except Exception:
+                self._log.exception("error in callback %r", callback)
+
+    async def _wait(self, until, deadline=None):
+        """
+        Sleep until the given time sampling the temperature when the
+        read fits before the deadline (default: until)
+        """
+        deadline = until if deadline is None else deadline
+        while True:
+            now = time.monotonic()
+            if now >= until:
+                return
+            if now >= self._next_sample:
+                if self._sample_fits(deadline):
+                    self._next_sample = now + self.sample_period
+                    await self._sample()
+                    continue
+                wake = until
+            else:
+                wake = min(until, self._next_sample)
+            await asyncio.sleep(wake - now)
+
+    async def _write(self, deadline, value):
+        """Write the set point at deadline. Returns how late it was sent"""
+        await self._wait(deadline - self._slot(), deadline)
+        try:
+            await self.device.write_at(self.register.command(value), deadline)
+        except Exception as error:
+            # the next write will bring the set point back on track
+            self._log.error("error writing %s=%r: %r", self.set_point, value, error)
+            return 0.0
+        sent = time.monotonic()
+        self._written = value
+        self.writes.append(Write(deadline, sent, value))
+        return sent - deadline
+
+    async def _ramp(self, segment_start, start, segment):
+        """Write the set points of a segment, planning again if writes get late"""
+        duration, target = segment_duration(segment, start), segment.target
+        offset, origin, late = 0.0, start, False
+        while True:
+            remaining = Ramp(target, duration=duration - offset)
+            _, writes = plan_segment(
+                origin, remaining, self.resolution, self._interval, self.quantum
+            )
+            for i, (t, value) in enumerate(writes):
+                if value == self._written:
+                    continue
+                lateness = await self._write(segment_start + offset + t, value)
+                if lateness > self.tolerance and i + 1 < len(writes):
+                    break
+                late = False
+            else:
+                return
+            if late:
+                # late twice in a row: other requests keep delaying the writes
+                self._interval += lateness
+                self._log.info(
+                    "writes late: interval increased to %.3fs", self._interval
+                )
+            late = True
+            # plan the rest of the ramp from the time the write was sent
+            sent = self.writes[-1].sent - segment_start
+            offset = min(sent + self._interval / 2, duration)
+            origin = start + (target - start) * offset / duration
+
+    async def _settle(self, target, band):
+        """Sample until the temperature is within band of the target"""
+        while True:
+            now = time.monotonic()
+            if now < self._next_sample:
+                await asyncio.sleep(self._next_sample - now)
+            self._next_sample = time.monotonic() + self.sample_period
+            await self._sample()
+            progress = self.progress
+            if progress is not None and abs(progress.temperature - target) <= band:
+                return
+
+    async def run(self):
+        """Execute the whole program. Returns the report()"""
+        device = self.device
+        start = self.start_value
+        if start is None:
+            start = await getattr(device, self.set_point)()
+        self.writes = []
+        self._error_count, self._error_sum2, self._error_max = 0, 0.0, 0.0
+        self._total = self._nominal_duration(start)
+        self._t0 = segment_start = time.monotonic()
+        self._next_sample = self._t0
+        self._written = start
+        offset = 0.0
+        for index, segment in enumerate(self.segments):
+            # give each segment a chance to go back to the fastest write rate
+            self._interval = max(self._min_interval(), (self._interval or 0) / 2)
+            duration = segment_duration(segment, start)
+            if isinstance(segment, Soak):
+                if segment.band is not None:
+                    self._ideal = index, segment_start, start, start, 0.0, offset
+                    await self._settle(start, segment.band)
+                    segment_start = max(segment_start, time.monotonic())
+                self._ideal = index, segment_start, start, start, duration, offset
+            else:
+                self._ideal = (
+                    index, segment_start, start, segment.target, duration, offset
+                )
+                await self._ramp(segment_start, start, segment)
+                start = segment.target
+            segment_start += duration
+            offset += duration
+            await self._wait(segment_start)
+        return self.report()
+
+    def _nominal_duration(self, start):
+        total = 0.0
+        for segment in self.segments:
+            total += segment_duration(segment, start)
+            start = getattr(segment, "target", start)
+        return total
+
+    def report(self):
+        """Timing and tracking statistics of the last (or current) run"""
+        lateness = [w.sent - w.deadline for w in self.writes]
+        n = self._error_count
+        return {
+            "writes": len(self.writes),
+            "lateness_mean": sum(lateness) / len(lateness) if lateness else 0.0,
+            "lateness_max": max(map(abs, lateness)) if lateness else 0.0,
+            "samples": n,
+            "tracking_error_rms": math.sqrt(self._error_sum2 / n) if n else 0.0,
+            "tracking_error_max": self._error_max,
+        }
+
+    @property
+    def done(self):
+        return self._task is not None and self._task.done()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+        return self._task
+
+    async def stop(self):
+        """Abort the program (the set point is left as is)"""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.stop()
@@ -1,7 +1,15 @@
+import enum
 import time
+import random
 import asyncio
 import logging
 import threading
+import collections
+import concurrent.futures
+
+from .metrics import Metrics
+from .connection import is_connection_error
+from .scheduler import Priority, AIOPriorityLock, IOPriorityLock
 
 
 def encode(data):
@@ -12,111 +20,781 @@ def encode(data):
     return data
 
 
+def clean(data):
+    # remove '\r\n', DTS1 (XON) and DTS3 (XOFF) in a single pass
+    return data.translate(None, b"\r\n\x11\x13")
+
+
 def decode(data):
-    data = data.strip()                # remove '\r\n'
-    data = data.replace(b"\x11", b"")  # remove DTS1 (XON)
-    data = data.replace(b"\x13", b"")  # remove DTS3 (XOFF)
-    return data.decode()
+    return clean(data).decode().strip()
+
+
+LatencyProfile = collections.namedtuple(
+    "LatencyProfile", "command query min_command min_query"
+)
+
+# set latency (see pag.72 of CF31 manual "Important times for
+# a command transmission"); 250ms after command; 10ms after query.
+# The minimum values are only reached by an adaptive Latency.
+DEFAULT_LATENCY_PROFILE = LatencyProfile(0.250, 0.01, 0.05, 0.002)
+
+# model -> LatencyProfile. Only the CF31 manual documents the times: the
+# other models use DEFAULT_LATENCY_PROFILE unless a measured profile is
+# registered here (ex: LATENCY_PROFILES["FC"] = LatencyProfile(...))
+LATENCY_PROFILES = {
+    "CF": DEFAULT_LATENCY_PROFILE,
+}
+
+
+class Latency:
+    """
+    Latency scheduler: time the device needs to be left alone after a
+    command and after a query.
+
+    If adaptive, the query latency is slowly decreased (down to the
+    profile minimum) while the device keeps replying and quickly
+    increased (up to the profile nominal value) when it starts dropping
+    replies. A dropped command gives no signal so the command latency is
+    only decreased when a command is verified (see verified()) and goes
+    back to nominal on any failure.
+    """
+
+    def __init__(self, profile=DEFAULT_LATENCY_PROFILE, adaptive=False,
+                 decrease=0.98, increase=2.0):
+        self.adaptive = adaptive
+        self.decrease = decrease
+        self.increase = increase
+        self.replies = 0
+        self.errors = 0
+        self.reply_time = None
+        self.profile = profile
+
+    def __repr__(self):
+        return "{}(command={:.3f}, query={:.3f}, adaptive={})".format(
+            type(self).__name__, self.command, self.query, self.adaptive
+        )
+
+    @property
+    def profile(self):
+        return self._profile
+
+    @profile.setter
+    def profile(self, profile):
+        self._profile = profile
+        self._command_floor = profile.min_command
+        self.command = profile.command
+        self.query = profile.query
+
+    def reply(self, duration):
+        """Register a successful query which took the given duration (s)"""
+        self.replies += 1
+        if self.reply_time is None:
+            self.reply_time = duration
+        else:
+            self.reply_time = 0.9 * self.reply_time + 0.1 * duration
+        if self.adaptive:
+            self.query = max(self._profile.min_query, self.query * self.decrease)
+
+    def error(self):
+        """Register a query which got no (valid) reply"""
+        self.errors += 1
+        if self.adaptive:
+            self._command_failed()
+            self.query = min(self._profile.query, self.query * self.increase)
+
+    def verified(self, applied):
+        """
+        Register whether a command was applied by the device (ex: the
+        register read back has the written value)
+        """
+        if not self.adaptive:
+            return
+        if applied:
+            self.command = max(self._command_floor, self.command * self.decrease)
+        else:
+            self._command_failed()
+
+    def _command_failed(self):
+        nominal = self._profile.command
+        if self.command < nominal:
+            # probably too fast: never go that low again
+            self._command_floor = min(nominal, self.command / self.decrease)
+        self.command = nominal
+
+
+class ConnectionState(enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    DOWN = "down"
 
 
 class BaseProtocol:
     """
     Handles communication protocol
     - latency
-    - encode/decode bytes <-> text
+    - encode/decode bytes <-> text (query() works on bytes directly)
     - serializes read calls
+    - resynchronization after a timeout or an unexpected reply
+    - connection lifecycle
+
+    *checks* maps an encoded request to a callable which raises an error if
+    the given (cleaned) reply bytes are not a valid reply to that request.
+    *reply_hooks* maps an encoded request to a callable called with every
+    valid (cleaned) reply to that request (ex: to watch VERSION replies).
+
+    If auto_open, the connection is opened on the first request and
+    reopened after a connection error. Failed attempts (and connections
+    lost before any reply) are retried with an exponential backoff (with
+    jitter) starting at reconnect_delay and up to max_reconnect_delay
+    seconds. Meanwhile requests fail immediately.
+    *listeners* are called with the new ConnectionState on every transition.
+
+    metrics: Metrics (or True to create one) to collect protocol metrics
     """
 
-    # set latency (see pag.72 of CF31 manual "Important times for
-    # a command transmission"); 250ms after command; 10ms after query
-    COMMAND_LATENCY = 0.250
-    QUERY_LATENCY = 0.01
+    COMMAND_LATENCY = DEFAULT_LATENCY_PROFILE.command
+    QUERY_LATENCY = DEFAULT_LATENCY_PROFILE.query
 
-    def __init__(self, connection, log=None):
+    def __init__(self, connection, log=None, latency=None, auto_open=True,
+                 reconnect_delay=0.5, max_reconnect_delay=30.0, metrics=None):
         self.conn = connection
+        if metrics is True:
+            metrics = Metrics()
+        self.metrics = metrics or None
+        self.auto_open = auto_open
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.state = ConnectionState.CLOSED
+        self.listeners = []
+        self._failures = 0
+        self._retry_at = 0
+        if latency is None:
+            latency = Latency(DEFAULT_LATENCY_PROFILE._replace(
+                command=self.COMMAND_LATENCY, query=self.QUERY_LATENCY
+            ))
+        self.latency = latency
+        self.checks = {}
+        self.reply_hooks = {}
+        self._unverified = {}
+        self.resyncs = 0
+        self._dirty = False
         self._last_query = 0
         self._last_command = 0
         self._log = log or logging.getLogger('julabo.{}'.format(type(self).__name__))
 
     def _wait_time(self):
         now = time.monotonic()
-        future = max(self._last_query + self.QUERY_LATENCY,
-                     self._last_command + self.COMMAND_LATENCY)
+        future = max(self._last_query + self.latency.query,
+                     self._last_command + self.latency.command)
         return future - now
 
+    def _reply(self, reply, start):
+        if reply.endswith(b"\n"):
+            self.latency.reply(time.monotonic() - start)
+            # only a reply proves the connection works
+            self._failures = 0
+        else:
+            # timeout on a serial line returns an incomplete reply
+            self.latency.error()
+            self._dirty = True
+            if self.metrics is not None:
+                self.metrics.timeouts += 1
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self._log.info("connection %s -> %s", self.state.value, state.value)
+        self.state = state
+        # listeners may remove themselves
+        for listener in list(self.listeners):
+            try:
+                result = listener(state)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception:
+                self._log.exception("error in connection listener %r", listener)
+
+    def _check_down(self):
+        wait = self._retry_at - time.monotonic()
+        if wait > 0:
+            raise ConnectionError(
+                "connection is down (next retry in {:.1f}s)".format(wait)
+            )
+
+    def _backoff(self):
+        delay = min(self.max_reconnect_delay,
+                    self.reconnect_delay * 2 ** self._failures)
+        delay *= random.uniform(0.5, 1.0)
+        self._failures += 1
+        self._retry_at = time.monotonic() + delay
+        return delay
+
+    def _open_failed(self, error):
+        delay = self._backoff()
+        self._log.warning("failed to open (retry in %.1fs): %r", delay, error)
+        self._set_state(ConnectionState.DOWN)
+
+    def _opened(self):
+        # _dirty is kept: some transports (ex: sockio) close the socket on a
+        # timeout and a serial to ethernet bridge may still deliver the late
+        # reply on the new one. _failures is only reset by a reply
+        self._set_state(ConnectionState.OPEN)
+
+    def _lost(self, error):
+        if self._failures:
+            # lost again without a single reply (ex: a bridge accepting
+            # connections and dropping them): back off
+            delay = self._backoff()
+            self._log.warning("connection lost (retry in %.1fs): %r", delay, error)
+        else:
+            # next request reconnects right away. If that fails, backoff starts
+            self._failures = 1
+            self._log.warning("connection lost: %r", error)
+        self._set_state(ConnectionState.DOWN)
+
+    def _valid(self, data, reply):
+        check = self.checks.get(data)
+        if check is not None:
+            try:
+                check(reply)
+            except (ValueError, TypeError, KeyError):
+                self._log.warning("unexpected reply %r to %r", reply, data)
+                self._dirty = True
+                if self.metrics is not None:
+                    self.metrics.decode_errors += 1
+                return False
+        if self._unverified:
+            self._verify(data, reply)
+        if self.reply_hooks:
+            hook = self.reply_hooks.get(data)
+            if hook is not None:
+                try:
+                    hook(reply)
+                except Exception:
+                    self._log.exception("error in reply hook %r", hook)
+        return True
+
+    def _sent(self, data):
+        # adaptive latency: remember the value to verify on the next read back
+        if self.latency.adaptive:
+            register, _, value = data.rstrip(b"\r").partition(b" ")
+            if value and register.startswith(b"OUT_"):
+                self._unverified[b"IN_" + register[4:] + b"\r"] = value.strip()
+
+    def _verify(self, data, reply):
+        expected = self._unverified.pop(data, None)
+        if expected is None:
+            return
+        try:
+            applied = float(expected) == float(reply)
+        except ValueError:
+            applied = expected == reply.strip()
+        if not applied:
+            self._log.info("command not applied: %r read back %r", expected, reply)
+        self.latency.verified(applied)
+
+
+def register_of(data):
+    """Register of an encoded command (ex: b"OUT_SP_00 22.3\\r" -> b"OUT_SP_00")"""
+    return data.split(None, 1)[0]
+
 
 class AIOProtocol(BaseProtocol):
+    """
+    asyncio protocol.
+
+    Requests are served by priority (see Priority): by default commands
+    first, then queries. If queued, write() returns a future immediately.
+    Commands are sent by a single drain task respecting the command latency.
+    Pending commands to the same register are coalesced (last writer wins)
+    before being sent.
+    """
 
-    def __init__(self, connection, log=None):
-        super().__init__(connection, log=log)
-        self._lock = asyncio.Lock()
+    def __init__(self, connection, queued=False, aging=1.0, **kwargs):
+        super().__init__(connection, **kwargs)
+        self._lock = AIOPriorityLock(aging=aging)
+        if self.metrics is not None:
+            self.metrics.wait_stats = self._lock.stats
+        self.queued = queued
+        self._pending = collections.OrderedDict()
+        self._drain_task = None
+
+    @property
+    def wait_stats(self):
+        """Time spent waiting for the communication per Priority"""
+        return self._lock.stats
 
     async def _back_pressure(self):
         wait = self._wait_time()
         if wait > 0:
+            if self.metrics is not None:
+                self.metrics.back_pressure(wait)
             await asyncio.sleep(wait)
 
-    async def write(self, data):
-        data = encode(data)
+    async def _ensure_open(self, force=False):
+        if self.conn.is_open:
+            self._set_state(ConnectionState.OPEN)
+            return
+        if not (self.auto_open or force):
+            return
+        self._check_down()
+        try:
+            await self.conn.open()
+        except Exception as error:
+            self._open_failed(error)
+            raise
+        self._opened()
+
+    async def _connection_error(self, error):
+        if not is_connection_error(error):
+            return
+        try:
+            await self.conn.close()
+        except Exception:
+            pass
+        self._lost(error)
+
+    async def open(self, priority=Priority.INTERACTIVE):
+        """
+        Open the connection if not open (even without auto_open).
+        Fails immediately while waiting for the next reconnection attempt
+        """
+        async with self._lock(priority):
+            await self._ensure_open(force=True)
+
+    async def close(self):
+        """Send the pending (queued) commands and close the connection"""
+        # otherwise the drain task would reopen the connection to send them
+        if asyncio.current_task() is not self._drain_task:
+            await self.flush()
+        await self.conn.close()
+        self._set_state(ConnectionState.CLOSED)
+
+    async def _write(self, data):
+        await self._ensure_open()
         self._log.debug("write: %r", data)
         await self._back_pressure()
         try:
             await self.conn.write(data)
+        except Exception as error:
+            await self._connection_error(error)
+            raise
         finally:
             self._last_command = time.monotonic()
+        self._sent(data)
+        if self.metrics is not None:
+            self.metrics.command(data)
+
+    async def _write_locked(self, data, priority):
+        async with self._lock(priority):
+            await self._write(data)
+
+    def write(self, data, priority=Priority.COMMAND):
+        data = encode(data)
+        if self.queued:
+            return self._enqueue(data)
+        return self._write_locked(data, priority)
 
-    async def write_readline(self, data):  # aka: query or put_get
+    async def write_at(self, data, deadline, priority=Priority.COMMAND):
+        """
+        Send the command at the given time.monotonic() deadline (never
+        queued). The communication is reserved from the moment the lock
+        is acquired (call it slightly before the deadline)
+        """
         data = encode(data)
+        async with self._lock(priority):
+            wait = deadline - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._write(data)
+
+    def _enqueue(self, data):
+        future = asyncio.get_event_loop().create_future()
+        register = register_of(data)
+        pending = self._pending.get(register)
+        if pending is None:
+            self._pending[register] = data, [future]
+        else:
+            self._log.debug("coalesce: %r -> %r", pending[0], data)
+            self._pending[register] = data, pending[1] + [future]
+        if self._drain_task is None:
+            self._drain_task = asyncio.ensure_future(self._drain())
+        return future
+
+    async def _drain(self):
+        try:
+            while self._pending:
+                async with self._lock(Priority.COMMAND):
+                    # wait before choosing the command so that writes
+                    # arriving in the meantime can still be coalesced
+                    await self._back_pressure()
+                    _, (data, futures) = self._pending.popitem(last=False)
+                    try:
+                        await self._write(data)
+                    except Exception as error:
+                        self._log.error("error writing %r: %r", data, error)
+                        for future in futures:
+                            if not future.done():
+                                future.set_exception(error)
+                    else:
+                        for future in futures:
+                            if not future.done():
+                                future.set_result(None)
+        finally:
+            self._drain_task = None
+            # only when cancelled: don't leave anyone waiting forever
+            for _, futures in self._pending.values():
+                for future in futures:
+                    future.cancel()
+            self._pending.clear()
+
+    async def flush(self):
+        """Wait for all pending (queued) commands to be sent"""
+        while self._drain_task is not None:
+            await asyncio.shield(self._drain_task)
+
+    async def _flush(self):
+        # give a late reply the chance to arrive before discarding it
+        await asyncio.sleep(self.latency.query)
+        result = self.conn.reset_input_buffer()
+        if asyncio.iscoroutine(result):
+            await result
+
+    async def _resync(self):
+        self.resyncs += 1
+        if self.metrics is not None:
+            self.metrics.resyncs += 1
+        self._log.info("resynchronizing (#%d)", self.resyncs)
+        await self._flush()
+        self._dirty = False
+
+    async def _query_once(self, data):
+        await self._ensure_open()
+        if self._dirty:
+            await self._resync()
         self._log.debug("write: %r", data)
         await self._back_pressure()
+        start = time.monotonic()
         try:
-            async with self._lock:
-                # TODO: maybe consume garbage in the buffer ?
-                reply = await self.conn.write_readline(data)
-            self._log.debug("read: %r", reply)
-            return decode(reply)
+            reply = await self.conn.write_readline(data)
+        except Exception as error:
+            self.latency.error()
+            if self.metrics is not None:
+                self.metrics.error(error)
+            # a late reply may still arrive
+            self._dirty = True
+            await self._connection_error(error)
+            raise
         finally:
             self._last_query = time.monotonic()
+        self._reply(reply, start)
+        if self.metrics is not None:
+            self.metrics.query(data, reply, self._last_query - start)
+        self._log.debug("read: %r", reply)
+        return clean(reply)
+
+    async def _query(self, data):
+        reply = await self._query_once(data)
+        if not self._valid(data, reply):
+            # probably a stale reply: flush and re-issue once
+            reply = await self._query_once(data)
+            self._valid(data, reply)
+        return reply
+
+    async def query(self, data, priority=Priority.INTERACTIVE):
+        """
+        Query with an encoded request (ex: b"IN_PV_00\\r").
+        Returns the reply bytes without EOL and XON/XOFF
+        """
+        async with self._lock(priority):
+            return await self._query(data)
+
+    async def query_many(self, lines, priority=Priority.INTERACTIVE):
+        """
+        Query several encoded requests in a single transaction. The lock is
+        held for the whole sequence and queries are spaced just by the latency
+        """
+        async with self._lock(priority):
+            return [await self._query(data) for data in lines]
+
+    # aka: query or put_get
+    async def write_readline(self, data, priority=Priority.INTERACTIVE):
+        return (await self.query(encode(data), priority)).decode().strip()
+
+    async def write_readlines(self, lines, priority=Priority.INTERACTIVE):
+        lines = [encode(line) for line in lines]
+        replies = await self.query_many(lines, priority)
+        return [reply.decode().strip() for reply in replies]
 
 
 class IOProtocol(BaseProtocol):
+    """
+    Synchronous (thread safe) protocol. Requests are served by priority
+    (see Priority): by default commands first, then queries.
+    If queued, write() returns a concurrent.futures.Future immediately.
+    Commands are sent by a dispatcher thread respecting the command
+    latency, so the caller never sleeps on it. Pending commands to the
+    same register are coalesced (last writer wins) before being sent.
+    """
 
-    def __init__(self, connection, log=None):
-        super().__init__(connection, log=log)
-        self._lock = threading.Lock()
+    def __init__(self, connection, queued=False, aging=1.0, **kwargs):
+        super().__init__(connection, **kwargs)
+        self._lock = IOPriorityLock(aging=aging)
+        if self.metrics is not None:
+            self.metrics.wait_stats = self._lock.stats
+        self.queued = queued
+        self._pending = collections.OrderedDict()
+        self._pending_lock = threading.Condition()
+        self._dispatcher = None
+
+    @property
+    def wait_stats(self):
+        """Time spent waiting for the communication per Priority"""
+        return self._lock.stats
 
     def _back_pressure(self):
         wait = self._wait_time()
         if wait > 0:
+            if self.metrics is not None:
+                self.metrics.back_pressure(wait)
             time.sleep(wait)
 
-    def write(self, data):
-        data = encode(data)
+    def _ensure_open(self, force=False):
+        if self.conn.is_open:
+            self._set_state(ConnectionState.OPEN)
+            return
+        if not (self.auto_open or force):
+            return
+        self._check_down()
+        try:
+            self.conn.open()
+        except Exception as error:
+            self._open_failed(error)
+            raise
+        self._opened()
+
+    def _connection_error(self, error):
+        if not is_connection_error(error):
+            return
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        self._lost(error)
+
+    def open(self, priority=Priority.INTERACTIVE):
+        """
+        Open the connection if not open (even without auto_open).
+        Fails immediately while waiting for the next reconnection attempt
+        """
+        with self._lock(priority):
+            self._ensure_open(force=True)
+
+    def close(self):
+        """Send the pending (queued) commands and close the connection"""
+        # otherwise the dispatcher would reopen the connection to send them
+        if threading.current_thread() is not self._dispatcher:
+            self.flush()
+        self.conn.close()
+        self._set_state(ConnectionState.CLOSED)
+
+    def _write(self, data):
+        self._ensure_open()
         self._log.debug("write: %r", data)
         self._back_pressure()
         try:
-            return self.conn.write(data)
+            result = self.conn.write(data)
+        except Exception as error:
+            self._connection_error(error)
+            raise
         finally:
             self._last_command = time.monotonic()
+        self._sent(data)
+        if self.metrics is not None:
+            self.metrics.command(data)
+        return result
+
+    def write(self, data, priority=Priority.COMMAND):
+        data = encode(data)
+        if self.queued:
+            return self._enqueue(data)
+        with self._lock(priority):
+            return self._write(data)
 
-    def write_readline(self, data):  # aka: query or put_get
+    def write_at(self, data, deadline, priority=Priority.COMMAND):
+        """
+        Send the command at the given time.monotonic() deadline (never
+        queued). The communication is reserved from the moment the lock
+        is acquired (call it slightly before the deadline)
+        """
         data = encode(data)
+        with self._lock(priority):
+            wait = deadline - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            return self._write(data)
+
+    def _enqueue(self, data):
+        future = concurrent.futures.Future()
+        register = register_of(data)
+        with self._pending_lock:
+            pending = self._pending.get(register)
+            if pending is None:
+                self._pending[register] = data, [future]
+            else:
+                self._log.debug("coalesce: %r -> %r", pending[0], data)
+                self._pending[register] = data, pending[1] + [future]
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(
+                    target=self._dispatch, name="julabo-dispatcher", daemon=True
+                )
+                self._dispatcher.start()
+        return future
+
+    def _dispatch(self):
+        try:
+            while True:
+                # sleep without holding the communication so that queries
+                # allowed by the latency rules can still go through
+                wait = self._wait_time()
+                if wait > 0:
+                    time.sleep(wait)
+                with self._lock(Priority.COMMAND):
+                    # wait before choosing the command so that writes
+                    # arriving in the meantime can still be coalesced
+                    self._back_pressure()
+                    with self._pending_lock:
+                        if not self._pending:
+                            # in the same critical section as _enqueue's
+                            # check so no write is left without dispatcher
+                            self._dispatcher = None
+                            self._pending_lock.notify_all()
+                            return
+                        _, (data, futures) = self._pending.popitem(last=False)
+                    futures = [f for f in futures if f.set_running_or_notify_cancel()]
+                    if not futures:
+                        continue
+                    try:
+                        self._write(data)
+                    except Exception as error:
+                        self._log.error("error writing %r: %r", data, error)
+                        for future in futures:
+                            future.set_exception(error)
+                    else:
+                        for future in futures:
+                            future.set_result(None)
+        except BaseException:
+            # unexpected error: don't leave anyone waiting forever
+            with self._pending_lock:
+                self._dispatcher = None
+                for _, futures in self._pending.values():
+                    for future in futures:
+                        future.cancel()
+                self._pending.clear()
+                self._pending_lock.notify_all()
+            raise
+
+    def flush(self, timeout=None):
+        """
+        Wait for all pending (queued) commands to be sent.
+        Returns False if the timeout expired
+        """
+        with self._pending_lock:
+            return self._pending_lock.wait_for(
+                lambda: self._dispatcher is None, timeout
+            )
+
+    def _flush(self):
+        # give a late reply the chance to arrive before discarding it
+        time.sleep(self.latency.query)
+        self.conn.reset_input_buffer()
+
+    def _resync(self):
+        self.resyncs += 1
+        if self.metrics is not None:
+            self.metrics.resyncs += 1
+        self._log.info("resynchronizing (#%d)", self.resyncs)
+        self._flush()
+        self._dirty = False
+
+    def _query_once(self, data):
+        self._ensure_open()
+        if self._dirty:
+            self._resync()
         self._log.debug("write: %r", data)
         self._back_pressure()
+        start = time.monotonic()
         try:
-            with self._lock:
-                # TODO: maybe consume garbage in the buffer ?
-                reply = self.conn.write_readline(data)
-            self._log.debug("read: %r", reply)
-            return decode(reply)
+            reply = self.conn.write_readline(data)
+        except Exception as error:
+            self.latency.error()
+            if self.metrics is not None:
+                self.metrics.error(error)
+            # a late reply may still arrive
+            self._dirty = True
+            self._connection_error(error)
+            raise
         finally:
             self._last_query = time.monotonic()
+        self._reply(reply, start)
+        if self.metrics is not None:
+            self.metrics.query(data, reply, self._last_query - start)
+        self._log.debug("read: %r", reply)
+        return clean(reply)
+
+    def _query(self, data):
+        reply = self._query_once(data)
+        if not self._valid(data, reply):
+            # probably a stale reply: flush and re-issue once
+            reply = self._query_once(data)
+            self._valid(data, reply)
+        return reply
+
+    def query(self, data, priority=Priority.INTERACTIVE):
+        """
+        Query with an encoded request (ex: b"IN_PV_00\\r").
+        Returns the reply bytes without EOL and XON/XOFF
+        """
+        with self._lock(priority):
+            return self._query(data)
+
+    def query_many(self, lines, priority=Priority.INTERACTIVE):
+        """
+        Query several encoded requests in a single transaction. The lock is
+        held for the whole sequence and queries are spaced just by the latency
+        """
+        with self._lock(priority):
+            return [self._query(data) for data in lines]
+
+    # aka: query or put_get
+    def write_readline(self, data, priority=Priority.INTERACTIVE):
+        return self.query(encode(data), priority).decode().strip()
+
+    def write_readlines(self, lines, priority=Priority.INTERACTIVE):
+        lines = [encode(line) for line in lines]
+        return [reply.decode().strip() for reply in self.query_many(lines, priority)]
+
+
+def Protocol(connection, **kwargs):
+    """
+    Protocol for the given connection. A shared connection (see
+    connection_for_url(shared=True)) always gets the same protocol (lock
+    and latency state included): arguments only apply to the first call.
+    """
+    entry = getattr(connection, "registry_entry", None)
+    if entry is not None:
+        with entry.lock:
+            if entry.protocol is None:
+                # opens through the registry, never releases a reference
+                handle = type(connection)(entry, counted=False)
+                entry.protocol = _protocol_class(entry.connection)(handle, **kwargs)
+            return entry.protocol
+    return _protocol_class(connection)(connection, **kwargs)
 
 
-def Protocol(connection):
+def _protocol_class(connection):
     func = connection.write_readline
-    klass = AIOProtocol if asyncio.iscoroutinefunction(func) else IOProtocol
-    return klass(connection)
+    return AIOProtocol if asyncio.iscoroutinefunction(func) else IOProtocol
 
 
 def protocol_for_url(url, *args, **kwargs):
@@ -0,0 +1,211 @@
+import csv
+import math
+import array
+import logging
+
+from .poller import Poller
+
+
+class RingBuffer:
+    """
+    Fixed size buffer of (timestamp, value) float pairs backed by two
+    array("d"). When full, appending overwrites the oldest sample.
+    Memory is 16 bytes per sample whatever the run length.
+    Timestamps are expected to be appended in increasing order.
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("RingBuffer size must be at least 1")
+        self.size = size
+        self.times = array.array("d", bytes(8 * size))
+        self.values = array.array("d", bytes(8 * size))
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __repr__(self):
+        return "{}(size={}, len={})".format(type(self).__name__, self.size, self._count)
+
+    @property
+    def nbytes(self):
+        return (self.times.itemsize + self.values.itemsize) * self.size
+
+    def append(self, timestamp, value):
+        if self._count < self.size:
+            index = self._start + self._count
+            if index >= self.size:
+                index -= self.size
+            self._count += 1
+        else:
+            index = self._start
+            self._start = index + 1 if index + 1 < self.size else 0
+        self.times[index] = timestamp
+        self.values[index] = value
+
+    def clear(self):
+        self._start = self._count = 0
+
+    def _index(self, i):
+        # logical index (0 is the oldest sample) -> array index
+        return (self._start + i) % self.size
+
+    def _bisect(self, timestamp):
+        # logical index of the first sample with time >= timestamp
+        lo, hi = 0, self._count
+        times, start, size = self.times, self._start, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[(start + mid) % size] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _range(self, start=None, stop=None):
+        first = 0 if start is None else self._bisect(start)
+        last = self._count if stop is None else self._bisect(stop)
+        return first, last
+
+    def _slice(self, data, first, last):
+        # data in logical range [first, last) as (at most) two array slices
+        begin, end = self._start + first, self._start + last
+        if end <= self.size:
+            return data[begin:end]
+        if begin >= self.size:
+            return data[begin - self.size:end - self.size]
+        return data[begin:] + data[:end - self.size]
+
+    def window(self, start=None, stop=None):
+        """
+        Samples with start <= timestamp < stop (default: all) as two
+        arrays (timestamps, values)
+        """
+        first, last = self._range(start, stop)
+        times = self._slice(self.times, first, last)
+        return times, self._slice(self.values, first, last)
+
+    def last(self):
+        """Most recent (timestamp, value) or None if empty"""
+        if not self._count:
+            return None
+        index = self._index(self._count - 1)
+        return self.times[index], self.values[index]
+
+    def downsample(self, bucket, start=None, stop=None):
+        """
+        Aggregate samples (default: all) in buckets of *bucket* seconds.
+        Returns a list of (bucket start, min, max, mean, count)
+        """
+        times, values = self.window(start, stop)
+        result = []
+        current, low, high, total, n = None, None, None, 0.0, 0
+        for t, v in zip(times, values):
+            key = math.floor(t / bucket) * bucket
+            if key != current:
+                if current is not None:
+                    result.append((current, low, high, total / n, n))
+                current, low, high, total, n = key, v, v, 0.0, 0
+            if v < low:
+                low = v
+            elif v > high:
+                high = v
+            total += v
+            n += 1
+        if current is not None:
+            result.append((current, low, high, total / n, n))
+        return result
+
+
+class Recorder:
+    """
+    Bounded telemetry history of numeric members of an asyncio BaseJulabo.
+
+    Samples come from a Poller (created with the given periods if not
+    given) and are stored in one RingBuffer of *size* samples per member,
+    so memory per device is fixed (see *nbytes*).
+
+    Example::
+
+        recorder = Recorder(dev, {"bath_temperature": 1, "safety_temperature": 5},
+                            size=24 * 3600)
+        async with recorder:
+            ...
+            times, values = recorder.window("bath_temperature", start=time.time() - 600)
+            minutes = recorder.downsample("bath_temperature", 60)
+            recorder.to_csv("history.csv")
+    """
+
+    def __init__(self, device, periods, size=3600, poller=None):
+        self.poller = Poller(device, periods) if poller is None else poller
+        self._own_poller = poller is None
+        self.buffers = {name: RingBuffer(size) for name in periods}
+        self.poller.add_callback(self.record)
+        self._log = logging.getLogger("julabo.{}".format(type(self).__name__))
+
+    @property
+    def nbytes(self):
+        return sum(buff.nbytes for buff in self.buffers.values())
+
+    def record(self, sample):
+        """Store a Sample (non numeric values are ignored)"""
+        buff = self.buffers.get(sample.name)
+        if buff is None:
+            return
+        try:
+            value = float(sample.value)
+        except (TypeError, ValueError):
+            self._log.debug("ignored non numeric %s=%r", sample.name, sample.value)
+            return
+        buff.append(sample.timestamp, value)
+
+    def window(self, name, start=None, stop=None):
+        return self.buffers[name].window(start, stop)
+
+    def downsample(self, name, bucket, start=None, stop=None):
+        return self.buffers[name].downsample(bucket, start, stop)
+
+    def to_csv(self, file, names=None, start=None, stop=None):
+        """Write samples as "name,timestamp,value" rows to a path or file object"""
+        if isinstance(file, str):
+            with open(file, "w", newline="") as fobj:
+                return self.to_csv(fobj, names, start, stop)
+        writer = csv.writer(file)
+        writer.writerow(("name", "timestamp", "value"))
+        for name in self.buffers if names is None else names:
+            times, values = self.window(name, start, stop)
+            writer.writerows((name, t, v) for t, v in zip(times, values))
+
+    def to_npz(self, file, names=None, start=None, stop=None):
+        """
+        Save samples to a numpy .npz file with arrays <name>_timestamp and
+        <name>_value (requires numpy)
+        """
+        import numpy
+        arrays = {}
+        for name in self.buffers if names is None else names:
+            times, values = self.window(name, start, stop)
+            arrays[name + "_timestamp"] = numpy.array(times, dtype=float)
+            arrays[name + "_value"] = numpy.array(values, dtype=float)
+        numpy.savez(file, **arrays)
+
+    def start(self):
+        if self.record not in self.poller.callbacks:
+            self.poller.add_callback(self.record)
+        if self._own_poller:
+            self.poller.start()
+
+    async def stop(self):
+        """Stop recording (the poller is only stopped if it was created here)"""
+        if self._own_poller:
+            await self.poller.stop()
+        self.poller.remove_callback(self.record)
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.stop()
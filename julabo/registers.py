@@ -0,0 +1,273 @@
+import enum
+import collections
+
+
+class IntEnum(enum.IntEnum):
+
+    @classmethod
+    def decode(cls, v):
+        return cls(int(v))
+
+
+def make_encoder(klass):
+    def encode(value):
+        if isinstance(value, klass):
+            value = value.value
+        elif isinstance(value, str):
+            try:
+                value = int(value)
+            except ValueError:
+                value = getattr(klass, value.capitalize()).value
+        return str(value)
+    klass.encode = encode
+
+
+class SelfTunning(IntEnum):
+    Off = 0
+    Once = 1
+    Always = 2
+make_encoder(SelfTunning)
+
+
+class ExternalInput(IntEnum):
+    Voltage = 0
+    Current = 1
+make_encoder(ExternalInput)
+
+
+class TemperatureControl(IntEnum):
+    Internal = 0
+    External = 1
+make_encoder(TemperatureControl)
+
+
+class ControlMode(IntEnum):
+    Remote = 0
+    Local = 1
+make_encoder(ControlMode)
+
+
+class ControlDynamics(IntEnum):
+    Aperiodic = 0
+    Standard = 1
+make_encoder(ControlDynamics)
+
+
+class Codec:
+    """
+    Conversion of register values.
+
+    decode: reply bytes (already cleaned from EOL and XON/XOFF) -> value
+    encode: value -> text sent in the OUT_ command
+    check: raises ValueError if the given reply bytes are not a valid reply
+    """
+
+    def __init__(self, decode, encode=str, check=None, name=None):
+        self.decode = decode
+        self.encode = encode
+        self.check = check
+        self.name = name
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.name)
+
+
+def check_status(reply):
+    """STATUS reply is "<code> <text>" (ex: b"03 REMOTE START")"""
+    int(reply.split(None, 1)[0])
+
+
+def _text(reply):
+    return reply.decode().strip()
+
+
+TEXT = Codec(_text, name="text")
+STATUS = Codec(_text, check=check_status, name="status")
+BOOL = Codec(lambda v: v == b"1", lambda v: "1" if v else "0", int, "bool")
+INT = Codec(int, lambda v: str(int(v)), int, "int")
+FLOAT1 = Codec(float, lambda v: "{:.1f}".format(float(v)), float, "float1")
+FLOAT2 = Codec(float, lambda v: "{:.2f}".format(float(v)), float, "float2")
+# MODE_01 is the set point channel index (0..2)
+CHANNEL = Codec(lambda v: int(v) + 1, lambda v: str(int(v) - 1), int, "channel")
+
+
+def Enum(klass):
+    return Codec(klass.decode, klass.encode, klass.decode, klass.__name__)
+
+
+class Register(collections.namedtuple(
+        "Register", "name read write codec unit limits optional description")):
+    """
+    Declarative description of a device register.
+
+    name: member name (ex: "bath_temperature")
+    read: query mnemonic (ex: "IN_PV_00") or None if write only
+    write: command mnemonic (ex: "OUT_SP_00") or None if read only
+    codec: Codec
+    limits: (min, max) accepted when writing or None
+    optional: not supported by every device of the model
+    """
+
+    def __new__(cls, name, read=None, write=None, codec=TEXT, unit=None,
+                limits=None, optional=False, description=""):
+        return super().__new__(cls, name, read, write, codec, unit, limits,
+                               optional, description)
+
+    @property
+    def access(self):
+        return ("r" if self.read else "") + ("w" if self.write else "")
+
+    @property
+    def request(self):
+        """Precomputed query bytes (ex: b"IN_PV_00\\r")"""
+        return None if self.read is None else self.read.encode() + b"\r"
+
+    @property
+    def mnemonic(self):
+        """Register mnemonic without IN_/OUT_ prefix (ex: "PV_00")"""
+        name = self.read or self.write
+        return name.split("_", 1)[1] if name.startswith(("IN_", "OUT_")) else name
+
+    def command(self, value):
+        """Command bytes to write the given value"""
+        limits = self.limits
+        if limits is not None and not limits[0] <= float(value) <= limits[1]:
+            raise ValueError(
+                "{} {!r} outside limits {}".format(self.name, value, limits)
+            )
+        return "{} {}\r".format(self.write, self.codec.encode(value)).encode()
+
+
+class RegisterMap(collections.OrderedDict):
+    """Registers of a model by member name"""
+
+    def __init__(self, *registers):
+        super().__init__()
+        for item in registers:
+            for register in (item.values() if isinstance(item, dict) else [item]):
+                self[register.name] = register
+
+    def by_mnemonic(self, mnemonic):
+        """All registers for the given mnemonic (ex: "SP_00")"""
+        return [reg for reg in self.values() if reg.mnemonic == mnemonic]
+
+
+BASE = RegisterMap(
+    Register("identification", "VERSION", description="Model and version"),
+    Register("status", "STATUS", codec=STATUS, description="Status code and text"),
+    Register("is_started", "IN_MODE_05", codec=BOOL, description="Started?"),
+)
+
+
+CIRCULATOR = RegisterMap(
+    BASE,
+    Register("bath_temperature", "IN_PV_00", codec=FLOAT2, unit="degC",
+             description="Actual bath temperature"),
+    Register("heating_power", "IN_PV_01", codec=FLOAT2, unit="%",
+             description="Heating power being used"),
+    Register("external_temperature", "IN_PV_02", codec=FLOAT2, unit="degC",
+             description="Temperature registered by external PT100 sensor"),
+    Register("safety_temperature", "IN_PV_03", codec=FLOAT2, unit="degC",
+             description="Temperature registered by the safety sensor"),
+    Register("excess_temperature", "IN_PV_04", codec=FLOAT2, unit="degC",
+             description="Set point of the excess temperature protection"),
+    Register("set_point_1", "IN_SP_00", "OUT_SP_00", FLOAT2, "degC",
+             description="Working temperature set point channel 1"),
+    Register("set_point_2", "IN_SP_01", "OUT_SP_01", FLOAT2, "degC",
+             description="Working temperature set point channel 2"),
+    Register("set_point_3", "IN_SP_02", "OUT_SP_02", FLOAT2, "degC",
+             description="Working temperature set point channel 3"),
+    Register("high_temperature", "IN_SP_03", "OUT_SP_03", FLOAT2, "degC",
+             description="High temperature warning limit"),
+    Register("low_temperature", "IN_SP_04", "OUT_SP_04", FLOAT2, "degC",
+             description="Low temperature warning limit"),
+    Register("external_programmer_set_point", "IN_SP_05", codec=FLOAT2,
+             unit="degC", optional=True,
+             description="Set point of the external programmer"),
+    Register("heater_manipulated_variable", "IN_SP_06", "OUT_SP_06", FLOAT2,
+             "%", (-100, 100), optional=True,
+             description="Heater manipulated variable"),
+    Register("pump_pressure_stage", "IN_SP_07", "OUT_SP_07", INT, None, (1, 4),
+             optional=True, description="Pump pressure stage"),
+    Register("flow_rate", "IN_SP_08", codec=FLOAT2,
+             optional=True,
+             description="Value of the flowrate sensor (E-prog input)"),
+    Register("active_set_point_channel", "IN_MODE_01", "OUT_MODE_01", CHANNEL,
+             limits=(1, 3), description="Active set point channel"),
+    Register("self_tunning", "IN_MODE_02", "OUT_MODE_02", Enum(SelfTunning),
+             description="Self tunning (off|once|always)"),
+    Register("external_input", "IN_MODE_03", "OUT_MODE_03", Enum(ExternalInput),
+             description="External programmer input (voltage|current)"),
+    Register("temperature_control", "IN_MODE_04", "OUT_MODE_04",
+             Enum(TemperatureControl),
+             description="Temperature control (internal|external)"),
+    Register("control_dynamics", "IN_MODE_08", "OUT_MODE_08",
+             Enum(ControlDynamics), optional=True, description="Control dynamics"),
+    Register("safety_sensor_difference", "IN_PAR_00", codec=FLOAT2, unit="degC",
+             optional=True,
+             description="Difference between working and safety sensors"),
+    Register("external_time_constant", "IN_PAR_01", codec=FLOAT2, unit="s",
+             optional=True, description="Te: time constant of external bath"),
+    Register("internal_slope", "IN_PAR_02", codec=FLOAT2,
+             optional=True, description="Si: internal slope"),
+    Register("internal_time_constant", "IN_PAR_03", codec=FLOAT2, unit="s",
+             optional=True, description="Ti: time constant of internal bath"),
+    Register("co_speed", "IN_PAR_04", "OUT_PAR_04", FLOAT1, None, (0, 5),
+             optional=True, description="CoSpeed for external control"),
+    Register("pk_ph0_factor", "IN_PAR_05", codec=FLOAT2,
+             optional=True, description="Factor pk/ph0"),
+    Register("xp_internal", "IN_PAR_06", "OUT_PAR_06", FLOAT1, None, (0.1, 99.9),
+             optional=True, description="Xp of the internal control"),
+    Register("tn_internal", "IN_PAR_07", "OUT_PAR_07", INT, "s", (3, 9999),
+             optional=True, description="Tn of the internal control"),
+    Register("tv_internal", "IN_PAR_08", "OUT_PAR_08", INT, "s", (0, 999),
+             optional=True, description="Tv of the internal control"),
+    Register("xp_cascade", "IN_PAR_09", "OUT_PAR_09", FLOAT1, None, (0.1, 99.9),
+             optional=True, description="Xp of the cascade control"),
+    Register("proportional_cascade", "IN_PAR_10", "OUT_PAR_10", FLOAT1, None,
+             (1, 99.9), optional=True,
+             description="Proportional portion of the cascade control"),
+    Register("tn_cascade", "IN_PAR_11", "OUT_PAR_11", INT, "s", (3, 9999),
+             optional=True, description="Tn of the cascade control"),
+    Register("tv_cascade", "IN_PAR_12", "OUT_PAR_12", INT, "s", (0, 999),
+             optional=True, description="Tv of the cascade control"),
+    Register("max_cascade_temperature", "IN_PAR_13", "OUT_PAR_13", FLOAT2, "degC",
+             optional=True,
+             description="Maximum temperature of the cascade control"),
+    Register("min_cascade_temperature", "IN_PAR_14", "OUT_PAR_14", FLOAT2, "degC",
+             optional=True,
+             description="Minimum temperature of the cascade control"),
+    Register("upper_band_limit", "IN_PAR_15", "OUT_PAR_15", INT, "degC", (0, 200),
+             optional=True, description="Upper band limit"),
+    Register("lower_band_limit", "IN_PAR_16", "OUT_PAR_16", INT, "degC", (0, 200),
+             optional=True, description="Lower band limit"),
+    Register("max_cooling_power", "IN_HIL_00", "OUT_HIL_00", INT, "%",
+             optional=True, description="Desired maximum cooling power (CF41)"),
+    Register("max_heating_power", "IN_HIL_01", "OUT_HIL_01", INT, "%", (10, 100),
+             optional=True, description="Maximum heating power"),
+)
+
+
+FC = RegisterMap(
+    BASE,
+    Register("working_temperature", "IN_SP_00", "OUT_SP_00", FLOAT1, "degC",
+             description="Working temperature set point"),
+    Register("high_temperature", "IN_SP_01", codec=INT, unit="degC",
+             description="High temperature warning limit"),
+    Register("low_temperature", "IN_SP_02", codec=INT, unit="degC",
+             description="Low temperature warning limit"),
+    Register("control_ratio", "IN_SP_03", "OUT_SP_03", INT, "%",
+             description="Control ratio"),
+    Register("feed_temperature", "IN_PV_00", codec=FLOAT2, unit="degC",
+             description="Feed temperature"),
+    Register("external_temperature", "IN_PV_01", codec=FLOAT2, unit="degC",
+             description="Temperature registered by external PT100 sensor"),
+    Register("heater_capacity", "IN_PV_02", codec=FLOAT2, unit="%",
+             description="Heater capacity being used"),
+    Register("return_temperature", "IN_PV_03", codec=FLOAT2, unit="degC",
+             description="Return temperature"),
+    Register("safety_temperature", "IN_PV_04", codec=FLOAT2, unit="degC",
+             description="Temperature registered by the safety sensor"),
+    Register("control_mode", "IN_MODE_04", "OUT_MODE_04", Enum(ControlMode),
+             description="Control mode (remote|local)"),
+)
@@ -0,0 +1,145 @@
+import enum
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+
+
+class Priority(enum.IntEnum):
+    """Request classes (lower value is served first)"""
+    COMMAND = 0       # safety and commands (ex: stop, set point)
+    INTERACTIVE = 1   # user initiated queries
+    BACKGROUND = 2    # routine polling
+
+
+class WaitStats:
+    """Time requests of a given priority waited for the communication"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def __repr__(self):
+        return "{}(count={}, mean={:.6f}, max={:.6f})".format(
+            type(self).__name__, self.count, self.mean, self.max
+        )
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def add(self, wait):
+        self.count += 1
+        self.total += wait
+        if wait > self.max:
+            self.max = wait
+
+
+class _Acquire:
+    """(async) context manager: lock(priority) acquires the lock with priority"""
+
+    def __init__(self, lock, priority):
+        self.lock = lock
+        self.priority = priority
+
+    def __enter__(self):
+        self.lock.acquire(self.priority)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.lock.release()
+
+    async def __aenter__(self):
+        await self.lock.acquire(self.priority)
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        self.lock.release()
+
+
+class BasePriorityLock:
+    """
+    Lock which, when released, is handed to the waiting request with the
+    highest priority.
+
+    If aging (s) is given, a waiting request is promoted one priority level
+    for every *aging* seconds it waits, so low priority requests cannot
+    starve. With aging=None priorities are strict.
+    """
+
+    def __init__(self, aging=1.0):
+        self.aging = aging
+        self.stats = {priority: WaitStats() for priority in Priority}
+        self._locked = False
+        self._waiters = []
+        self._counter = itertools.count()
+
+    def _key(self, priority, start):
+        if self.aging is None:
+            return priority, next(self._counter)
+        return priority * self.aging + start, next(self._counter)
+
+    def _acquired(self, priority, start):
+        self.stats[priority].add(time.monotonic() - start)
+
+
+class AIOPriorityLock(BasePriorityLock):
+
+    async def acquire(self, priority=Priority.INTERACTIVE):
+        start = time.monotonic()
+        if not self._locked and not self._waiters:
+            self._locked = True
+            self._acquired(priority, start)
+            return
+        future = asyncio.get_event_loop().create_future()
+        entry = self._key(priority, start) + (future,)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # lock was handed to us meanwhile: pass it on
+                self.release()
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+        self._acquired(priority, start)
+
+    def release(self):
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[-1]
+            if not future.done():
+                # hand over: the lock stays locked
+                future.set_result(None)
+                return
+        self._locked = False
+
+    def __call__(self, priority=Priority.INTERACTIVE):
+        return _Acquire(self, priority)
+
+
+class IOPriorityLock(BasePriorityLock):
+
+    def __init__(self, aging=1.0):
+        super().__init__(aging=aging)
+        self._condition = threading.Condition()
+
+    def acquire(self, priority=Priority.INTERACTIVE):
+        start = time.monotonic()
+        with self._condition:
+            entry = self._key(priority, start)
+            heapq.heappush(self._waiters, entry)
+            while self._locked or self._waiters[0] is not entry:
+                self._condition.wait()
+            heapq.heappop(self._waiters)
+            self._locked = True
+        self._acquired(priority, start)
+
+    def release(self):
+        with self._condition:
+            self._locked = False
+            self._condition.notify_all()
+
+    def __call__(self, priority=Priority.INTERACTIVE):
+        return _Acquire(self, priority)
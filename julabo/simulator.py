@@ -14,27 +14,221 @@
       transports:
       - type: serial
         url: /tmp/julabo-cf31-1
+
+A whole fleet of devices can be created from a template. Each device gets
+the next TCP port and, optionally, per device variations (values are
+cycled). Realistic timing can be injected in any device:
+
+.. code-block:: yaml
+
+    fleets:
+    - count: 200
+      port: 20000
+      template:
+        class: JulaboCF
+        reply_delay: 0.005      # device processing time (s)
+        command_latency: 0.25   # busy time after a command (s)
+        query_latency: 0.01     # busy time after a query (s)
+        drop_rate: 0.001        # probability of not replying
+        xon_xoff: true          # add XON/XOFF bytes to replies
+      variations:
+        PV_00: ["20.1", "21.5", "19.8"]
+
+Run with ``python -m julabo.simulator -c fleet.yml`` (or start a fleet
+without configuration file: ``python -m julabo.simulator --count 200 --port 20000``)
 """
 
-from sinstruments.simulator import BaseDevice
+import math
+import time
+import random
+import logging
+import argparse
+
+import gevent
+from sinstruments.simulator import BaseDevice, create_server_from_config
+
+from .registers import CIRCULATOR
+
+
+EOL = b"\r\n"
+XON_XOFF = b"\x13\x11"
 
 
 class BaseJulabo(BaseDevice):
+    """
+    Base simulated julabo.
+
+    Replies are kept encoded (bytes) per request so answering a query is a
+    single dict lookup. Timing options:
+
+    - reply_delay: time (s) the device takes to reply
+    - command_latency, query_latency: time (s) the device ignores new
+      requests after a command/query (like the real hardware)
+    - drop_rate: probability of not replying to a query
+    - xon_xoff: add XON/XOFF flow control bytes to replies
+    - seed: random seed (for reproducible drops)
+    """
 
     DEFAULT = {}
 
+    # registers which can be written (OUT_<register>)
+    WRITABLE = frozenset()
+
     newline = b"\r"
 
-    def __init__(self, name, **opts):
+    def __init__(self, name, reply_delay=0, command_latency=0, query_latency=0,
+                 drop_rate=0, xon_xoff=False, seed=None, **opts):
         kwargs = {}
         if "newline" in opts:
             kwargs["newline"] = opts.pop("newline")
+        kwargs["server"] = opts.pop("server", None)
+        opts.pop("transports", None)
+        self.reply_delay = reply_delay
+        self.command_latency = command_latency
+        self.query_latency = query_latency
+        self.drop_rate = drop_rate
+        self.xon_xoff = xon_xoff
+        self._random = random.Random(seed)
+        self._busy_until = 0
         self._config = dict(self.DEFAULT, **opts)
+        self._replies = {}
+        # request -> callable returning the current value (computed at query time)
+        self._dynamic = {}
+        for register, value in self._config.items():
+            self._set(register, value)
         self._on = True
         super().__init__(name, **kwargs)
 
+    def _encode(self, value):
+        reply = str(value).encode() + EOL
+        if self.xon_xoff:
+            reply = XON_XOFF + reply
+        return reply
+
+    def _set(self, register, value):
+        self._config[register] = value
+        if register in ("VERSION", "STATUS"):
+            self._replies[register.encode()] = self._encode(value)
+        else:
+            self._replies[b"IN_" + register.encode()] = self._encode(value)
+
+    def _lookup(self, request):
+        reply = self._replies.get(request)
+        if reply is None:
+            func = self._dynamic.get(request)
+            if func is not None:
+                reply = self._encode(func())
+        return reply
+
+    def _write(self, register, value):
+        if register not in self.WRITABLE:
+            self._log.debug("ignored write to %r", register)
+            return
+        self._set(register, value)
+
+    def handle_message(self, line):
+        line = line.strip()
+        now = time.monotonic()
+        if now < self._busy_until:
+            self._log.debug("busy: ignored %r", line)
+            return
+        reply = self._lookup(line)
+        if reply is None:
+            line = line.upper()
+            reply = self._lookup(line)
+        if reply is not None:
+            self._busy_until = now + self.query_latency
+            if self.reply_delay:
+                gevent.sleep(self.reply_delay)
+            if self.drop_rate and self._random.random() < self.drop_rate:
+                self._log.debug("dropped reply to %r", line)
+                return
+            return reply
+        if line.startswith(b"OUT_"):
+            self._busy_until = now + self.command_latency
+            cmd, _, value = line.partition(b" ")
+            self._write(cmd[4:].decode(), value.strip().decode())
+        else:
+            self._log.debug("unknown request %r", line)
+
+
+def _time_constant(tau):
+    if not tau > 0:
+        raise ValueError("time constant must be > 0 (got {!r})".format(tau))
+    return tau
+
+
+class ThermalModel:
+    """
+    First order bath (time constant *tau*) whose rate of change is limited
+    to heating_rate/cooling_rate (K/s). The temperature is computed
+    analytically from the time elapsed since the last change of target, so
+    an idle simulated device costs nothing.
+    """
+
+    def __init__(self, temperature, tau, heating_rate=None, cooling_rate=None):
+        self.heating_rate = heating_rate
+        self.cooling_rate = cooling_rate
+        self.start_time = time.monotonic()
+        self.start_temperature = temperature
+        self.target = temperature
+        self.tau = _time_constant(tau)
+
+    def set_target(self, target, tau=None, heating_rate=None, cooling_rate=None):
+        """Re-anchor the model at the current temperature"""
+        if tau is not None:
+            _time_constant(tau)
+        now = time.monotonic()
+        self.start_temperature = self.temperature(now)
+        self.start_time = now
+        self.target = target
+        if tau is not None:
+            self.tau = tau
+        self.heating_rate = heating_rate
+        self.cooling_rate = cooling_rate
+
+    def _limit(self, delta):
+        return self.heating_rate if delta > 0 else self.cooling_rate
+
+    def temperature(self, now=None):
+        now = time.monotonic() if now is None else now
+        dt = now - self.start_time
+        tau, target = self.tau, self.target
+        delta = target - self.start_temperature
+        rate = self._limit(delta)
+        if rate:
+            # far from target: change at the maximum rate until the first
+            # order slope (delta / tau) drops below it
+            linear = (abs(delta) - rate * tau) / rate
+            if linear > 0:
+                if dt <= linear:
+                    return self.start_temperature + math.copysign(rate * dt, delta)
+                dt -= linear
+                delta = math.copysign(rate * tau, delta)
+        return target - delta * math.exp(-dt / tau)
+
+    def power(self, now=None):
+        """Fraction (-1..1) of the heating (>0) or cooling (<0) rate in use"""
+        slope = (self.target - self.temperature(now)) / self.tau
+        rate = self._limit(slope)
+        if not rate:
+            return 0.0
+        return max(-1.0, min(1.0, slope / rate))
+
 
 class BaseJulaboCirculator(BaseJulabo):
+    """
+    Simulated circulator. Unless thermal is false, bath (PV_00), external
+    (PV_02) and safety (PV_03) temperatures follow a ThermalModel:
+
+    - started: towards the active set point (SP_00..02 selected by MODE_01)
+      with the given time_constant (default: PAR_03) and heating/cooling
+      rate limits (K/s); PV_01 is the heating power in use
+    - stopped: towards ambient_temperature (default: initial PV_00) with
+      ambient_time_constant and no rate limits
+
+    External and safety sensors keep their initial offset to the bath.
+    """
 
     DEFAULT = {
         "MODE_01": "0",       # use set point (0..2)
@@ -80,25 +274,70 @@ class BaseJulaboCirculator(BaseJulabo):
         "PV_04": "34.44",     # set point temp of the excess temp protection
     }
 
-    def handle_message(self, line):
-        self._log.debug("request: %r", line)
-        line = line.decode().strip().upper()
-        if line in {"VERSION", "STATUS"}:
-            result = self._config[line]
-        elif line.startswith("IN_"):
-            result = self._config.get(line[3:])
-        else:
-            cmd, value = line.split(" ", 1)
-            self._config[cmd[4:]] = value
-            if cmd == "OUT_MODE_05":
-                status = "02 REMOTE STOP" if value == "0" else "03 REMOTE START"
-                self._config["STATUS"] = status
-            result = None
-        if result is None:
+    WRITABLE = frozenset(
+        register.write[4:] for register in CIRCULATOR.values() if register.write
+    ) | {"MODE_05"}
+
+    def __init__(self, name, thermal=True, time_constant=None,
+                 ambient_time_constant=None, heating_rate=0.1, cooling_rate=0.05,
+                 ambient_temperature=None, **opts):
+        super().__init__(name, **opts)
+        self._thermal = None
+        if not thermal:
             return
-        result = result.encode() + b"\r\n"
-        self._log.debug("reply: %r", result)
-        return result
+        config = self._config
+        bath = float(config["PV_00"])
+        if ambient_temperature is None:
+            ambient_temperature = bath
+        if time_constant is None:
+            time_constant = float(config["PAR_03"])
+        if ambient_time_constant is None:
+            ambient_time_constant = 10 * time_constant
+        self.ambient_temperature = ambient_temperature
+        self.time_constant = time_constant
+        self.ambient_time_constant = ambient_time_constant
+        self.heating_rate = heating_rate
+        self.cooling_rate = cooling_rate
+        self._thermal = ThermalModel(bath, self.ambient_time_constant)
+        self._retarget()
+        external = float(config["PV_02"]) - bath
+        safety = float(config["PV_03"]) - bath
+        temperature = self._thermal.temperature
+        self._dynamic.update({
+            b"IN_PV_00": lambda: "{:.2f}".format(temperature()),
+            b"IN_PV_01": lambda: "{:.0f}".format(100 * self._heating_power()),
+            b"IN_PV_02": lambda: "{:.2f}".format(temperature() + external),
+            b"IN_PV_03": lambda: "{:.2f}".format(temperature() + safety),
+        })
+        for request in self._dynamic:
+            self._replies.pop(request, None)
+
+    def _heating_power(self):
+        if self._config["MODE_05"] == "0":
+            return 0.0
+        return self._thermal.power()
+
+    def _retarget(self):
+        config = self._config
+        if config["MODE_05"] == "0":
+            self._thermal.set_target(self.ambient_temperature,
+                                     self.ambient_time_constant)
+        else:
+            set_point = float(config["SP_0{}".format(config["MODE_01"])])
+            self._thermal.set_target(set_point, self.time_constant,
+                                     self.heating_rate, self.cooling_rate)
+
+    def _write(self, register, value):
+        super()._write(register, value)
+        if register == "MODE_05":
+            status = "02 REMOTE STOP" if value == "0" else "03 REMOTE START"
+            self._set("STATUS", status)
+        retarget = ("MODE_01", "MODE_05", "SP_00", "SP_01", "SP_02")
+        if self._thermal is not None and register in retarget:
+            try:
+                self._retarget()
+            except (KeyError, ValueError) as error:
+                self._log.warning("invalid %s=%r: %r", register, value, error)
 
 
 class JulaboCF(BaseJulaboCirculator):
@@ -120,3 +359,85 @@ class JulaboMS(BaseJulaboCirculator):
         BaseJulaboCirculator.DEFAULT,
         VERSION="JULABO MAGIO MS 200-230V 50/60Hz VERSION 2.2.1"
     )
+
+
+def fleet_devices(count, template, port, host="0.0.0.0", name=None,
+                  variations=None):
+    """
+    Device configurations for *count* devices created from *template*
+    (a device configuration without name and transports) listening on
+    consecutive TCP ports starting at *port*. *variations* maps a device
+    option to a list of values (cycled over the devices).
+    """
+    template = dict(template)
+    template.setdefault("package", __name__)
+    if name is None:
+        name = template["class"] + "-{index:04d}"
+    variations = variations or {}
+    devices = []
+    for index in range(count):
+        device = dict(template)
+        for option, values in variations.items():
+            device[option] = values[index % len(values)]
+        device["name"] = name.format(index=index, port=port + index)
+        device["transports"] = [
+            {"type": "tcp", "url": "{}:{}".format(host, port + index)}
+        ]
+        devices.append(device)
+    return devices
+
+
+def expand_fleets(config):
+    """Configuration with the "fleets" section expanded into devices"""
+    config = dict(config)
+    devices = list(config.get("devices", ()))
+    for fleet in config.pop("fleets", ()):
+        devices.extend(fleet_devices(**fleet))
+    config["devices"] = devices
+    return config
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="julabo simulator")
+    parser.add_argument("-c", "--config-file", help="configuration file")
+    parser.add_argument("--count", type=int, default=1, help="fleet size")
+    parser.add_argument("--port", type=int, default=20000, help="first TCP port")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--class", dest="klass", default="JulaboCF",
+                        choices=["JulaboCF", "JulaboHL", "JulaboMS"])
+    parser.add_argument("--reply-delay", type=float, default=0)
+    parser.add_argument("--command-latency", type=float, default=0)
+    parser.add_argument("--query-latency", type=float, default=0)
+    parser.add_argument("--drop-rate", type=float, default=0)
+    parser.add_argument("--xon-xoff", action="store_true")
+    parser.add_argument("--log-level", default="WARNING")
+    options = parser.parse_args(args)
+    fmt = "%(asctime)-15s %(levelname)-5s %(name)s: %(message)s"
+    logging.basicConfig(format=fmt, level=options.log_level.upper())
+
+    if options.config_file:
+        from sinstruments.simulator import parse_config_file
+        config = parse_config_file(options.config_file)
+    else:
+        template = {
+            "class": options.klass,
+            "reply_delay": options.reply_delay,
+            "command_latency": options.command_latency,
+            "query_latency": options.query_latency,
+            "drop_rate": options.drop_rate,
+            "xon_xoff": options.xon_xoff,
+        }
+        config = {"fleets": [{
+            "count": options.count, "port": options.port,
+            "host": options.host, "template": template,
+        }]}
+    server = create_server_from_config(expand_fleets(config))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nCtrl-C Pressed. Bailing out...")
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
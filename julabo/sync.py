@@ -0,0 +1,159 @@
+"""
+Blocking facade over the asyncio stack.
+
+All devices share a single asyncio event loop running in a background
+thread. Each blocking call is executed in that loop, so many devices can
+be driven concurrently from synchronous code (see call_many()) without
+relying on IOProtocol.
+
+Example::
+
+    from julabo.sync import SyncJulabo, call_many
+
+    devs = [SyncJulabo(url) for url in urls]
+    for dev in devs:
+        dev.open()
+    temperatures = call_many(devs, "bath_temperature")
+"""
+
+import asyncio
+import threading
+
+from .connection import connection_for_url
+from .device import JulaboCF
+
+
+class EventLoop:
+    """asyncio event loop running in a background (daemon) thread"""
+
+    def __init__(self, name="JulaboLoop"):
+        self.name = name
+        self.loop = None
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.thread is not None:
+                return
+            started = threading.Event()
+
+            def run():
+                self.loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self.loop)
+                started.set()
+                self.loop.run_forever()
+
+            self.thread = threading.Thread(target=run, name=self.name, daemon=True)
+            self.thread.start()
+            started.wait()
+
+    def stop(self):
+        with self._lock:
+            if self.thread is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.thread = self.loop = None
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) in the event loop thread (awaiting the
+        result if needed). Returns a concurrent.futures.Future
+        """
+        async def call():
+            result = func(*args, **kwargs)
+            if hasattr(result, "__await__"):
+                result = await result
+            return result
+
+        self.start()
+        return asyncio.run_coroutine_threadsafe(call(), self.loop)
+
+    def run(self, func, *args, timeout=None, **kwargs):
+        """Same as submit() but blocks until the result is available"""
+        return self.submit(func, *args, **kwargs).result(timeout)
+
+
+_default_loop = None
+
+
+def default_loop():
+    """The event loop shared by all SyncJulabo objects (started on demand)"""
+    global _default_loop
+    if _default_loop is None:
+        _default_loop = EventLoop()
+    return _default_loop
+
+
+class SyncJulabo:
+    """
+    Blocking julabo device. The underlying asyncio device (see *julabo*)
+    lives in the shared event loop thread. Any member of the asyncio device
+    can be called and blocks until the reply is available.
+    """
+
+    def __init__(self, url, Julabo=JulaboCF, loop=None, timeout=None,
+                 **kwargs):
+        self.loop = default_loop() if loop is None else loop
+        self.timeout = timeout
+
+        def create():
+            connection = connection_for_url(url, concurrency="asyncio")
+            return Julabo(connection, **kwargs)
+
+        # create in the loop thread so asyncio primitives bind to that loop
+        self.julabo = self.loop.run(create)
+
+    def __getattr__(self, name):
+        attr = getattr(self.julabo, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self.loop.run(attr, *args, timeout=self.timeout, **kwargs)
+
+        call.__name__ = name
+        call.__doc__ = attr.__doc__
+        return call
+
+    def submit(self, name, *args, **kwargs):
+        """
+        Call the given member without blocking.
+        Returns a concurrent.futures.Future
+        """
+        return self.loop.submit(getattr(self.julabo, name), *args, **kwargs)
+
+    @property
+    def connection(self):
+        return self.julabo.protocol.conn
+
+    def open(self):
+        return self.loop.run(self.julabo.open, timeout=self.timeout)
+
+    def close(self):
+        return self.loop.run(self.julabo.close, timeout=self.timeout)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def call_many(devices, name, *args, timeout=None, **kwargs):
+    """
+    Call the same member on many SyncJulabo devices in parallel.
+    Returns the list of results (the exception instance for a failed device)
+    """
+    futures = [device.submit(name, *args, **kwargs) for device in devices]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result(timeout))
+        except Exception as error:
+            future.cancel()
+            results.append(error)
+    return results
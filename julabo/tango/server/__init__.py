@@ -1,4 +1,4 @@
-from .device import JulaboCF, JulaboFC, JulaboHL
+from .device import JulaboCF, JulaboFC, JulaboHL, WARM_UP
 
 
 def main():
@@ -9,4 +9,5 @@ def main():
     args = ['Julabo'] + sys.argv[1:]
     fmt = '%(asctime)s %(threadName)s %(levelname)s %(name)s %(message)s'
     logging.basicConfig(level=logging.INFO, format=fmt)
-    run((JulaboCF, JulaboHL, JulaboFC), args=args, green_mode=GreenMode.Asyncio)
+    run((JulaboCF, JulaboHL, JulaboFC), args=args, green_mode=GreenMode.Asyncio,
+        post_init_callback=WARM_UP.ready)
@@ -1,14 +1,135 @@
+import enum
+import time
+import asyncio
+import logging
 import functools
 
-from tango import DevState
-from tango.server import Device, attribute, command, device_property
+from tango import DevState, AttrQuality
+from tango.server import Device, attribute, command, device_property, class_property
 
 from julabo import (
     JulaboCF as _JulaboCF,
     JulaboHL as _JulaboHL,
     JulaboFC as _JulaboFC,
+    Poller,
     connection_for_url
 )
+from julabo.cache import StaticCache
+from julabo.protocol import ConnectionState, LATENCY_PROFILES, DEFAULT_LATENCY_PROFILE
+
+
+def parse_items(items, convert=float):
+    """["name=value", ...] -> {name: convert(value)}"""
+    result = {}
+    for item in items:
+        name, value = item.split("=", 1)
+        result[name.strip()] = convert(value.strip())
+    return result
+
+
+def parse_deadband(text):
+    """"0.05" -> (0.05, None) (absolute); "2%" -> (None, 0.02) (relative)"""
+    if text.endswith("%"):
+        return None, float(text[:-1]) / 100
+    return float(text), None
+
+
+def changed(old, new, deadband=(None, None)):
+    """True if new differs from old by at least the (absolute, relative) deadband"""
+    if old is None or type(old) is not type(new):
+        return True
+    absolute, relative = deadband
+    if isinstance(new, bool) or not isinstance(new, (int, float)) or \
+       (absolute is None and relative is None):
+        return new != old
+    delta = abs(new - old)
+    if delta == 0:
+        # a zero threshold (0 deadband or relative to 0) must not fire
+        return False
+    if absolute is not None and delta >= absolute:
+        return True
+    return relative is not None and delta >= relative * abs(old)
+
+
+class WarmUp:
+    """
+    Warm-up of all the devices of the server: connections are opened and
+    static registers prefetched concurrently (at most *parallel* at the
+    same time) while the server starts. Once the server is initialized
+    (see ready()) a timing report is logged. Devices (re)initialized
+    afterwards are warmed up and reported one by one.
+    """
+
+    def __init__(self):
+        self.parallel = None
+        self.tasks = {}
+        self.start = None
+        self.is_ready = False
+        self._semaphore = None
+        self._log = logging.getLogger("julabo.tango.WarmUp")
+
+    def add(self, device, parallel):
+        if self._semaphore is None:
+            self.parallel = parallel
+            self._semaphore = asyncio.Semaphore(parallel)
+            self.start = time.monotonic()
+        name = device.get_name()
+        task = asyncio.ensure_future(self._warm_up(device))
+        if self.is_ready:
+            task.add_done_callback(functools.partial(self._report_one, name))
+        else:
+            self.tasks[name] = task
+        return task
+
+    async def _warm_up(self, device):
+        async with self._semaphore:
+            return await device.warm_up()
+
+    def ready(self):
+        """Server initialized: report once all warm-ups are done"""
+        self.is_ready = True
+        if self.tasks:
+            asyncio.ensure_future(self.report())
+
+    def _report_one(self, name, task):
+        if task.cancelled():
+            return
+        result = task.result()
+        if "error" in result:
+            self._log.warning("%s warm-up failed: %r", name, result["error"])
+        else:
+            self._log.info("%s ready in %.3fs", name, result["total"])
+
+    async def report(self):
+        tasks, self.tasks = self.tasks, {}
+        await asyncio.wait(tasks.values())
+        total = time.monotonic() - self.start
+        timings, errors = {}, {}
+        for name, task in tasks.items():
+            if task.cancelled():
+                continue
+            result = task.result()
+            if "error" in result:
+                errors[name] = result["error"]
+            else:
+                timings[name] = result
+        self._log.info(
+            "%d devices ready in %.3fs (parallel=%d, %d failed)",
+            len(timings), total, self.parallel, len(errors)
+        )
+        for step in ("open", "prefetch", "total"):
+            values = [timing[step] for timing in timings.values()]
+            if values:
+                mean = sum(values) / len(values)
+                self._log.info(
+                    "  %s: mean=%.3fs max=%.3fs", step, mean, max(values)
+                )
+        for name, error in errors.items():
+            self._log.warning("  %s failed: %r", name, error)
+        return timings, errors
+
+
+WARM_UP = WarmUp()
 
 
 class BaseJulabo(Device):
@@ -17,26 +138,200 @@ class BaseJulabo(Device):
     baudrate = device_property(dtype=int, default_value=9600)
     bytesize = device_property(dtype=int, default_value=8)
     parity = device_property(dtype=str, default_value='N')
+    status_freshness = device_property(dtype=float, default_value=0.5)
+    # time (s) the device is left alone after a command/query
+    # (0: model latency profile)
+    command_latency = device_property(dtype=float, default_value=0)
+    query_latency = device_property(dtype=float, default_value=0)
+    # attributes acquired by an internal loop which pushes change and
+    # archive events: "<attribute>=<period (s)>"
+    event_periods = device_property(dtype=(str,), default_value=[])
+    # change deadbands: "<attribute>=<absolute>" or "<attribute>=<relative>%"
+    # (default: any change)
+    event_deadbands = device_property(dtype=(str,), default_value=[])
+    # push an archive event at least every archive_period seconds (0: only on change)
+    archive_period = device_property(dtype=float, default_value=0)
+    # maximum number of devices warming up at the same time
+    warm_up_parallel = class_property(dtype=int, default_value=16)
 
     Julabo = None
 
+    # members prefetched by the warm-up and cached while the connection lives
+    STATIC = ("identification",)
+
+    # tango attribute name -> julabo member name (when they differ)
+    MEMBERS = {}
+
     async def init_device(self):
         await super().init_device()
+        self._values = {}
+        self._status_future = None
+        self._status_time = 0
         kwargs = dict(concurrency="asyncio")
         if self.url.startswith("serial") or self.url.startswith("rfc2217"):
             kwargs = dict(baudrate=self.baudrate, bytesize=self.bytesize,
                           parity=self.parity)
         self.connection = connection_for_url(self.url, **kwargs)
-        self.julabo = self.Julabo(self.connection)
+        static = [getattr(self.Julabo, name).read for name in self.STATIC]
+        self.julabo = self.Julabo(
+            self.connection, cache=StaticCache(static),
+            latency_profile=self._latency_profile(),
+        )
+        self._init_events()
+        self._warm_up = WARM_UP.add(self, self.warm_up_parallel)
+
+    def _latency_profile(self):
+        if not (self.command_latency or self.query_latency):
+            return None
+        profile = LATENCY_PROFILES.get(self.Julabo.MODEL, DEFAULT_LATENCY_PROFILE)
+        command = self.command_latency or profile.command
+        query = self.query_latency or profile.query
+        return profile._replace(
+            command=command, query=query,
+            min_command=min(profile.min_command, command),
+            min_query=min(profile.min_query, query),
+        )
+
+    async def warm_up(self):
+        """
+        Open the connection (through the protocol, like any request) and
+        prefetch static registers (the latency profile is selected from
+        the identification). Returns the timings or the error
+        """
+        start = time.monotonic()
+        opened = []
+
+        def on_state(state):
+            if state == ConnectionState.OPEN and not opened:
+                opened.append(time.monotonic())
+
+        protocol = self.julabo.protocol
+        protocol.listeners.append(on_state)
+        try:
+            await self.julabo.detect_latency()
+            await self.julabo.read_many(*self.STATIC)
+        except Exception as error:
+            self.warn_stream("warm-up failed: {!r}".format(error))
+            return {"error": error}
+        finally:
+            protocol.listeners.remove(on_state)
+        end = time.monotonic()
+        # already open: nothing to time
+        opened = opened[0] if opened else start
+        return {"open": opened - start, "prefetch": end - opened, "total": end - start}
+
+    def _init_events(self):
+        periods = parse_items(self.event_periods)
+        self._deadbands = parse_items(self.event_deadbands, parse_deadband)
+        self._events = {}
+        self.poller = None
+        if not periods:
+            return
+        self._attributes = {}   # julabo member name -> tango attribute name
+        for name in periods:
+            self._attributes[self.MEMBERS.get(name, name)] = name
+            self.set_change_event(name, True, False)
+            self.set_archive_event(name, True, False)
+        self.poller = Poller(self.julabo, {
+            member: periods[name] for member, name in self._attributes.items()
+        })
+        self.poller.add_callback(self._push_events)
+        self.poller.start()
+
+    def _push_events(self, sample):
+        name = self._attributes[sample.name]
+        value, timestamp = sample.value, sample.timestamp
+        if isinstance(value, enum.Enum):
+            value = value.name
+        event = self._events.setdefault(name, [None, 0])  # last value, last archive
+        if changed(event[0], value, self._deadbands.get(name, (None, None))):
+            event[0] = value
+            self.push_change_event(name, value, timestamp, AttrQuality.ATTR_VALID)
+        elif not self.archive_period or timestamp - event[1] < self.archive_period:
+            return
+        event[1] = timestamp
+        self.push_archive_event(name, value, timestamp, AttrQuality.ATTR_VALID)
+
+    def _polled(self, member):
+        """Sample acquired by the event loop if still fresh"""
+        poller = self.poller
+        if poller is None:
+            return None
+        sample = poller.values.get(member)
+        if sample is None:
+            return None
+        if time.time() - sample.timestamp < poller.periods[member]:
+            return sample
 
     async def delete_device(self):
-        await self.connection.close()
+        self._warm_up.cancel()
+        if self.poller is not None:
+            await self.poller.stop()
+        await self.julabo.close()
+
+    async def read_attr_hardware(self, attr_list):
+        """Prefetch all requested attributes in a single transaction"""
+        self._values = {}
+        multi_attr = self.get_device_attr()
+        readable = set(self.julabo.readable_members())
+        members = {}
+        for index in attr_list:
+            name = multi_attr.get_attr_by_ind(index).get_name()
+            member = self.MEMBERS.get(name, name)
+            if member in readable and self._polled(member) is None:
+                members[name] = member
+        if len(members) < 2:
+            return
+        try:
+            values = await self.julabo.read_many(*set(members.values()))
+        except Exception as error:
+            # each attribute read will retry (and report) on its own
+            self.debug_stream("error prefetching attributes: %r", error)
+            return
+        self._values = {name: values[member] for name, member in members.items()}
+
+    async def _read(self, name):
+        """Value prefetched by read_attr_hardware or read it now"""
+        try:
+            return self._values.pop(name)
+        except KeyError:
+            member = self.MEMBERS.get(name, name)
+            sample = self._polled(member)
+            if sample is not None:
+                return sample.value
+            return await getattr(self.julabo, member)()
+
+    async def _write(self, name, value):
+        member = self.MEMBERS.get(name, name)
+        await getattr(self.julabo, member)(value)
+        if self.poller is not None:
+            # don't serve the value acquired before the write
+            self.poller.values.pop(member, None)
+
+    async def _acquire_status(self):
+        # the protocol opens (and reopens) the connection when needed
+        try:
+            return await self.julabo.status()
+        finally:
+            self._status_time = time.monotonic()
+
+    def _status(self):
+        """
+        STATUS reply shared by State, Status and anyone else during
+        status_freshness seconds. Concurrent requests share a single query
+        """
+        future = self._status_future
+        if future is None or (
+            future.done() and
+            time.monotonic() - self._status_time > self.status_freshness
+        ):
+            future = asyncio.ensure_future(self._acquire_status())
+            self._status_future = future
+        return asyncio.shield(future)
 
     async def dev_state(self):
         try:
-            if not self.connection.is_open:
-                await self.connection.open()
-            status_code = int((await self.julabo.status())[:2])
+            status_code = int((await self._status())[:2])
         except:
             return DevState.FAULT
         if status_code in {0, 2}:
@@ -49,9 +344,7 @@ class BaseJulabo(Device):
 
     async def dev_status(self):
         try:
-            if not self.connection.is_open:
-                await self.connection.open()
-            self.__status = await self.julabo.status()
+            self.__status = await self._status()
         except Exception as error:
             import traceback
             self.__status = "{!r}\n\nDetails:\n{}".format(
@@ -62,21 +355,23 @@ class BaseJulabo(Device):
     @attribute(dtype=str, label="Identification")
     async def identification(self):
         """Device identification (model and version)"""
-        return await self.julabo.identification()
+        return await self._read("identification")
 
     @attribute(dtype=bool, label="Is started?")
     async def is_started(self):
         """Is device started or not"""
-        return await self.julabo.is_started()
+        return await self._read("is_started")
 
     @command
     async def start(self):
         """Start the device"""
+        self._status_future = None
         await self.julabo.start()
 
     @command
     async def stop(self):
         """Stop the device"""
+        self._status_future = None
         await self.julabo.stop()
 
 
@@ -85,102 +380,102 @@ class BaseJulaboCirculator(BaseJulabo):
     @attribute(dtype=float, label="Bath temperature", unit="degC")
     async def bath_temperature(self):
         """Actual bath temperature"""
-        return await self.julabo.bath_temperature()
+        return await self._read("bath_temperature")
 
     @attribute(dtype=float, label="Heating power", unit="%")
     async def heating_power(self):
         """Heating power being used"""
-        return await self.julabo.heating_power()
+        return await self._read("heating_power")
 
     @attribute(dtype=float, label="External temperature", unit="degC")
     async def external_temperature(self):
         """Temperature registered by external PT100 sensor"""
-        return await self.julabo.external_temperature()
+        return await self._read("external_temperature")
 
     @attribute(dtype=float, label="Safety temperature", unit="degC")
     async def safety_temperature(self):
         """Temperature registered by the safety sensor"""
-        return await self.julabo.safety_temperature()
+        return await self._read("safety_temperature")
 
     @attribute(dtype=float, label="Set point 1", unit="degC")
     async def set_point_1(self):
         """Working temperature set point channel 1"""
-        return await self.julabo.set_point_1()
+        return await self._read("set_point_1")
 
     @set_point_1.setter
     async def set_point_1(self, value):
-        await self.julabo.set_point_1(value)
+        await self._write("set_point_1", value)
 
     @attribute(dtype=float, label="Set point 2", unit="degC")
     async def set_point_2(self):
         """Working temperature set point channel 2"""
-        return await self.julabo.set_point_2()
+        return await self._read("set_point_2")
 
     @set_point_2.setter
     async def set_point_2(self, value):
-        await self.julabo.set_point_2(value)
+        await self._write("set_point_2", value)
 
     @attribute(dtype=float, label="Set point 3", unit="degC")
     async def set_point_3(self):
         """Working temperature set point channel 3"""
-        return await self.julabo.set_point_3()
+        return await self._read("set_point_3")
 
     @set_point_3.setter
     async def set_point_3(self, value):
-        await self.julabo.set_point_3(value)
+        await self._write("set_point_3", value)
 
     @attribute(dtype=float, label="High temperature", unit="degC")
     async def high_temperature(self):
         """High temperature warning limit"""
-        return await self.julabo.high_temperature()
+        return await self._read("high_temperature")
 
     @high_temperature.setter
     async def high_temperature(self, value):
-        await self.julabo.high_temperature(value)
+        await self._write("high_temperature", value)
 
     @attribute(dtype=float, label="Low temperature", unit="degC")
     async def low_temperature(self):
         """Low temperature warning limit"""
-        return await self.julabo.low_temperature()
+        return await self._read("low_temperature")
 
     @low_temperature.setter
     async def low_temperature(self, value):
-        await self.julabo.low_temperature(value)
+        await self._write("low_temperature", value)
 
     @attribute(dtype=int, label="Active set point channel", min_value=1, max_value=3)
     async def active_set_point_channel(self):
-        return await self.julabo.active_set_point_channel()
+        return await self._read("active_set_point_channel")
 
     @active_set_point_channel.setter
     async def active_set_point_channel(self, value):
-        await self.julabo.active_set_point_channel(value)
+        await self._write("active_set_point_channel", value)
 
     @attribute(dtype=str, label="Self tunning")
     async def self_tunning(self):
         """Self tunning (off|once|always)"""
-        return (await self.julabo.self_tunning()).name
+        return (await self._read("self_tunning")).name
 
     @self_tunning.setter
     async def self_tunning(self, value):
-        await self.julabo.self_tunning(value)
+        await self._write("self_tunning", value)
 
     @attribute(dtype=str, label="External input")
     async def external_input(self):
         """External programmer input (voltage|current)"""
-        return (await self.julabo.external_input()).name
+        return (await self._read("external_input")).name
 
     @external_input.setter
     async def external_input(self, value):
-        await self.julabo.external_input(value)
+        await self._write("external_input", value)
 
     @attribute(dtype=str, label="Temperature control")
     async def temperature_control(self):
         """Temperature control (internal|external)"""
-        return (await self.julabo.temperature_control()).name
+        return (await self._read("temperature_control")).name
 
     @temperature_control.setter
     async def temperature_control(self, value):
-        await self.julabo.temperature_control(value)
+        await self._write("temperature_control", value)
 
 
 class JulaboCF(BaseJulaboCirculator):
@@ -202,48 +497,48 @@ class JulaboFC(BaseJulabo):
 
     @attribute(dtype=float)
     async def working_temperature(self):
-        return await self.julabo.working_temperature()
+        return await self._read("working_temperature")
 
     @working_temperature.setter
     async def working_temperature(self, value):
-        await self.julabo.working_temperature(value)
+        await self._write("working_temperature", value)
 
     @attribute(dtype=int)
     async def high_temperature(self):
-        return await self.julabo.high_temperature()
+        return await self._read("high_temperature")
 
     @attribute(dtype=int)
     async def low_temperature(self):
-        return await self.julabo.low_temperature()
+        return await self._read("low_temperature")
 
     @attribute(dtype=int)
     async def control_ratio(self):
-        return await self.julabo.control_ratio()
+        return await self._read("control_ratio")
 
     @control_ratio.setter
     async def control_ratio(self, value):
-        await self.julabo.control_ratio(value)
+        await self._write("control_ratio", value)
 
     @attribute(dtype=float)
     async def feed_temperature(self):
-        return await self.julabo.feed_temperature()
+        return await self._read("feed_temperature")
 
     @feed_temperature.setter
     async def feed_temperature(self, value):
-        await self.julabo.feed_temperature(value)
+        await self._write("feed_temperature", value)
 
     @attribute(dtype=float)
     async def external_temperature(self):
-        return await self.julabo.external_temperature()
+        return await self._read("external_temperature")
 
     @attribute(dtype=float)
     async def heater_capacity(self):
-        return await self.julabo.heater_capacity()
+        return await self._read("heater_capacity")
 
     @attribute(dtype=float)
     async def return_temperature(self):
-        return await self.julabo.return_temperature()
+        return await self._read("return_temperature")
 
     @attribute(dtype=float)
     async def safety_temperature(self):
-        return await self.julabo.safety_temperature()
+        return await self._read("safety_temperature")
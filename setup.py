@@ -29,12 +29,16 @@ setup(
     entry_points={
         "console_scripts": [
             "Julabo = julabo.tango.server:main [tango]",
+            "julabo-simulator = julabo.simulator:main [simulator]",
+            "julabo-monitor = julabo.monitor:main",
         ],
         'sinstruments.device': [
             'JulaboCF = julabo.simulator:JulaboCF [simulator]',
-            'JulaboHL = julabo.simulator:JulaboHL [simulator]'
+            'JulaboHL = julabo.simulator:JulaboHL [simulator]',
+            'JulaboMS = julabo.simulator:JulaboMS [simulator]'
         ]
     },
+    python_requires=">=3.7",
     install_requires=requirements,
     extras_require=extras_require,
     classifiers=[
@@ -42,8 +46,6 @@ setup(
         "Intended Audience :: Developers",
         "Development Status :: 2 - Pre-Alpha",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         'License :: OSI Approved :: GNU Lesser General Public License v3 or later (LGPLv3+)'